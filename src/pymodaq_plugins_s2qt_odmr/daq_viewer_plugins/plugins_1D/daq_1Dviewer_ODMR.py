@@ -1,3 +1,5 @@
+import threading
+
 import numpy as np
 from easydict import EasyDict as edict
 from pymodaq.utils.daq_utils import ThreadCommand, getLineInfo
@@ -6,17 +8,40 @@ from pymodaq.control_modules.viewer_utility_classes import DAQ_Viewer_base, \
     comon_parameters, main
 from pymodaq.utils.parameter import Parameter
 from pymodaq.utils.parameter import utils as putils
-from pymodaq_plugins_rohdeschwarz.hardware.SMA_SMB_MW_sources import MWsource
-from pymodaq_plugins_daqmx.hardware.national_instruments.daqmx import DAQmx, \
-    Edge, ClockSettings, ClockCounter, SemiPeriodCounter, TriggerSettings, AIChannel
-from PyDAQmx import DAQmxConnectTerms, DAQmx_Val_DoNotInvertPolarity, \
-     DAQmx_Val_ContSamps, DAQmx_Val_FiniteSamps, DAQmx_Val_CurrReadPos, \
-     DAQmx_Val_DoNotOverwriteUnreadSamps, DAQmx_Val_Rising
+from pymodaq_plugins_daqmx.hardware.national_instruments.daqmx import DAQmx, Edge
 # shared UnitRegistry from pint initialized in __init__.py
 from pymodaq_plugins_s2qt_odmr import ureg, Q_
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_controller import ODMRController
+from pymodaq_plugins_s2qt_odmr.hardware.acquisition_process import ODMRProcess
+from pymodaq_plugins_s2qt_odmr.hardware.sweep_plan import sweep_axis
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import sweep_to_pl, topo_mean, \
+    decimate, DeadTimeCorrection, QualityMonitor, DEAD_TIME_MODELS, DECIMATION_MODES
+from pymodaq_plugins_s2qt_odmr.hardware.saving import FullResolutionWriter
+from pymodaq_plugins_s2qt_odmr.hardware.emission import EmissionPipeline, \
+    OVERFLOW_POLICIES
+from pymodaq_plugins_s2qt_odmr.hardware.errors import SweepFailed
 
 debug_add = "USB::0x0AAD::0x0054::105357::INSTR"
 
+# labels of the Quality channels, in the order of QualityMetrics
+QUALITY_LABELS = ["SNR", "Contrast", "Drift", "Spikes", "Accepted"]
+
+
+def extra_counter_group(index):
+    """Parameters of an additional counter, gated by the same clock
+    as the main one."""
+    return {"title": f"Counter {index}:", "name": f"counter{index}",
+            "type": "group", "children": [
+                {"title": "Counting channel:", "name": "counter_channel",
+                 "type": "list",
+                 "limits": DAQmx.get_NIDAQ_channels(source_type="Counter")},
+                {"title": "Photon source:", "name": "photon_channel",
+                 "type": "list", "limits": DAQmx.getTriggeringSources()},
+                {"title": "Reference?", "name": "reference", "type": "bool",
+                 "value": False}
+            ]}
+
+
 class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
     """ Plugin generating a 1D viewer based on a RS MW source
     and a NI card based counter to perform ODMR measurement of
@@ -24,6 +49,9 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
     communicate with PyMoDAQ Module through inheritance of
     DAQ_Viewer_base.
     """
+    # a continuous grab runs in the plugin, see live_loop
+    live_mode_available = True
+
     params = comon_parameters + [
         {"title": "Epsilon", "name": "epsilon", "type": "float",
          "value": 0.1, "visible": False},
@@ -51,6 +79,18 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
                     "limits": Edge.names(), "visible": False},
                    {"title": "Level:", "name": "level", "type": "float",
                     "value": 1., "visible": False}
+               ]},
+              {"title": "Dead time correction:", "name": "dead_time_settings",
+               "type": "group", "visible": True, "children": [
+                   {"title": "Model:", "name": "dead_time_model", "type": "list",
+                    "limits": DEAD_TIME_MODELS},
+                   {"title": "Dead time (ns):", "name": "dead_time", "type": "float",
+                    "value": 22., "min": 0.}
+               ]},
+              {"title": "Extra counters:", "name": "extra_counters",
+               "type": "group", "visible": True, "children": [
+                   {"title": "Number of extra counters:", "name": "nb_counters",
+                    "type": "int", "value": 0, "min": 0}
                ]}
           ]},
         {"title": "Acquisition settings", "name": "acq_settings", "type":
@@ -69,7 +109,16 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
                     "value": 2},
                ]},
               {"title": "List mode?", "name": "list", "type": "bool",
-               "value": False}
+               "value": False},
+              {"title": "Reference points", "name": "reference_settings", "type":
+               "group", "children": [
+                   {"title": "Interleave reference?", "name": "interleaved",
+                    "type": "bool", "value": False},
+                   {"title": "Reference frequency (MHz):", "name": "ref_f",
+                    "type": "float", "value": 2500},
+                   {"title": "Reference power (dBm):", "name": "ref_power",
+                    "type": "float", "value": -145}
+               ]}
           ]},
         {"title": "Further NI card settings", "name": "ni_settings", "type":
           "group", "children": [
@@ -79,15 +128,72 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
                   'limits': DAQmx.get_NIDAQ_channels(source_type='Analog_Input')},
               {'title': 'Sync trigger channel:', 'name': 'sync_channel', 'type': 'list',
                 'limits': DAQmx.getTriggeringSources()},
+              {'title': 'Concurrent setup?', 'name': 'concurrent_setup', 'type': 'bool',
+               'value': True},
+              {'title': 'Setup time (ms):', 'name': 'setup_time', 'type': 'float',
+               'value': 0., 'readonly': True},
+              {'title': 'Separate process (at init)?', 'name': 'separate_process',
+               'type': 'bool', 'value': False},
+              ]},
+        {"title": "Emission settings", "name": "emission_settings", "type":
+          "group", "children": [
+              {"title": "Asynchronous emission?", "name": "async_emission",
+               "type": "bool", "value": True},
+              {"title": "Queue size:", "name": "queue_size", "type": "int",
+               "value": 4, "min": 1},
+              {"title": "When queue is full:", "name": "overflow_policy",
+               "type": "list", "limits": OVERFLOW_POLICIES},
+              {"title": "Dropped sweeps:", "name": "dropped", "type": "int",
+               "value": 0, "readonly": True},
+              {"title": "Decimation:", "name": "decimation", "type": "list",
+               "limits": DECIMATION_MODES},
+              {"title": "Max displayed points:", "name": "max_points", "type": "int",
+               "value": 2000, "min": 2},
+              {"title": "Save full resolution?", "name": "save_full", "type": "bool",
+               "value": False},
+              {"title": "Full resolution folder:", "name": "full_folder",
+               "type": "browsepath", "value": "", "filetype": False},
+              ]},
+        {"title": "Error handling", "name": "error_settings", "type":
+          "group", "children": [
+              {"title": "Number of attempts:", "name": "attempts", "type": "int",
+               "value": 3, "min": 1},
+              {"title": "Retry delay (ms):", "name": "backoff", "type": "float",
+               "value": 100., "min": 0.},
+              {"title": "Failed sweeps:", "name": "failed", "type": "int",
+               "value": 0, "readonly": True},
+              ]},
+        {"title": "Quality metrics", "name": "quality_settings", "type":
+          "group", "children": [
+              {"title": "Compute metrics?", "name": "metrics", "type": "bool",
+               "value": False},
+              {"title": "Spike threshold (sigma):", "name": "clip_sigma",
+               "type": "float", "value": 5., "min": 1.},
+              {"title": "Remove spikes?", "name": "remove_spikes", "type": "bool",
+               "value": True},
+              {"title": "Max spikes per sweep:", "name": "max_outliers", "type": "int",
+               "value": -1, "min": -1, "tip": "-1 to accept all sweeps"},
+              {"title": "Max baseline drift (%):", "name": "max_drift", "type": "float",
+               "value": 0., "min": 0., "tip": "0 to accept all sweeps"},
+              {"title": "Stop at SNR:", "name": "snr_target", "type": "float",
+               "value": 0., "min": 0., "tip": "0 to never stop"},
+              {"title": "Max re-grabs:", "name": "max_regrabs", "type": "int",
+               "value": 3, "min": 0,
+               "tip": "Rejected sweeps acquired again for a point of a scan"},
+              {"title": "Averaged sweeps:", "name": "nb_sweeps", "type": "int",
+               "value": 0, "readonly": True},
+              {"title": "Rejected sweeps:", "name": "rejected", "type": "int",
+               "value": 0, "readonly": True},
               ]}
         
     ]
 
     def ini_attributes(self):
+        self.controller: ODMRController = None  # or ODMRProcess
         self.mw_controller = None
-        self.counter_controller = None
 
         self.x_axis = None
+        self.x_axis_frequencies = None  # cached array of sweep_axis used to build x_axis
         self.start_f = 2820 * ureg.MHz
         self.stop_f = 2920 * ureg.MHz
         self.step_f = 2 * ureg.MHz
@@ -95,6 +201,18 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
         self.list_mode = False
         self.nb_ranges = 1
         self.live = False  # True during a continuous grab
+        self.live_thread = None  # thread running live_loop
+        self.live_stop = threading.Event()
+        self.dead_time_correction = DeadTimeCorrection()
+        self.decimation = "none"
+        self.max_points = 2000
+        self.full_writer = None  # FullResolutionWriter if the full spectra are saved
+        self.quality = None  # QualityMonitor if the quality metrics are computed
+        self.emission = EmissionPipeline(self.process_sweep,
+                                         self.data_grabed_signal.emit)
+        # unbounded, so that the throttling of the display never drops saved sweeps
+        self.saving = EmissionPipeline(self.full_resolution_data, self.write_full_resolution,
+                                       maxsize=float("inf"))
 
     def commit_settings(self, param: Parameter):
         """Apply the consequences of a change of value in the detector
@@ -106,13 +224,65 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
             A given parameter (within detector_settings) whose value
             has been changed by the user
         """
-        # MW settings
+        # the live thread may be acquiring a sweep, the MW source is only
+        # driven between two sweeps
+        with self.controller.lock:
+            self.commit_mw_settings(param)
+
+        if param.name() == "nb_ranges":
+            self.nb_ranges = param.value()
+            self.update_x_axis()
+        elif param.name() == "start_f":
+            self.start_f = param.value() * ureg.MHz
+            self.update_x_axis()
+        elif param.name() == "stop_f":
+            self.stop_f = param.value() * ureg.MHz
+            self.update_x_axis()
+        elif param.name() == "step_f":
+            self.step_f = param.value() * ureg.MHz
+            self.update_x_axis()
+
+        elif param.name() == "nb_counters":
+            self.update_extra_counters(param.value())
+
+        # Dead time correction, the object is replaced and not modified
+        # since it is used by the emission worker
+        elif param.name() in ["dead_time_model", "dead_time"]:
+            self.update_dead_time_correction()
+
+        # Emission settings
+        elif param.name() == "async_emission":
+            if not param.value():
+                self.emission.stop()
+            elif self.live_thread is not None:
+                self.emission.start()
+        elif param.name() == "queue_size":
+            self.emission.maxsize = param.value()
+        elif param.name() == "overflow_policy":
+            self.emission.policy = param.value()
+        elif param.name() == "decimation":
+            self.decimation = param.value()
+        elif param.name() == "max_points":
+            self.max_points = param.value()
+        elif param.name() in ["save_full", "full_folder"]:
+            self.update_full_writer()
+
+        # Quality metrics, the monitor is replaced and not modified since it
+        # is used by the emission worker
+        elif param.name() in ["metrics", "clip_sigma", "max_outliers", "max_drift",
+                              "snr_target"]:
+            self.update_quality_monitor()
+
+    def commit_mw_settings(self, param):
+        """Apply a change of the MW settings or of the sweep mode to the MW
+        source, called with the lock of the controller."""
         if param.name() == "address":
             self.mw_controller.set_address(param.value())
+            self.controller.mw_ready = False
         elif param.name() == "power":
             power_to_set = Q_(param.value(), ureg.dBm)
             self.mw_controller.set_cw_params(power=power_to_set)
-        
+
         # Freq sweep settings
         if param.name() == "sweep":
             if param.value() and self.nb_ranges == 1:
@@ -144,19 +314,10 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
                 self.list_mode = True
                 self.mw_controller.set_list()
                 self.settings.child("acq_settings", "sweep").setValue(True)
-                    
-        elif param.name() == "nb_ranges":
-            self.nb_ranges = param.value()
-            self.update_x_axis()
-        elif param.name() == "start_f":
-            self.start_f = param.value() * ureg.MHz
-            self.update_x_axis()
-        elif param.name() == "stop_f":
-            self.stop_f = param.value() * ureg.MHz
-            self.update_x_axis()
-        elif param.name() == "step_f":
-            self.step_f = param.value() * ureg.MHz
-            self.update_x_axis()
+
+        if param.name() in ["sweep", "list"]:
+            # the source has to be programmed again in the new mode
+            self.controller.mw_ready = False
 
     def ini_detector(self, controller=None):
         """Detector communication initialization
@@ -173,14 +334,20 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
         initialized: bool
             False if initialization failed otherwise True
         """
-        self.mw_controller = MWsource()
+        if self.settings.child("ni_settings", "separate_process").value():
+            # the hardware is driven by another process, free from the
+            # load of the dashboard
+            self.controller = ODMRProcess()
+        else:
+            self.controller = ODMRController()
+        self.mw_controller = self.controller.mw_source
+        self.update_config()
+        self.update_processing()
         mw_initialized = self.mw_controller.open_communication(
-            address=self.settings.child("mwsettings", "address").value())
+            address=self.controller.config.address)
         
         try:
-            self.counter_controller = {"clock": DAQmx(), "counter": DAQmx(),
-                                       "ai": DAQmx()}
-            self.update_tasks()
+            self.controller.update_tasks()
             counter_initialized = True
         except Exception as e:
             print(e)
@@ -196,21 +363,37 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
             self.settings.child("mwsettings", "power").setValue(
                 self.mw_controller.get_power().magnitude)
             self.update_x_axis()
+            labels = self.pl_labels()
             # Initialize viewers panel with the future type of data
-            self.data_grabed_signal_temp.emit(
-                [DataFromPlugins(name='ODMR', data=[np.zeros(len(self.x_axis['data']))],
-                                 dim='Data1D', labels=['ODMR'],
-                                 x_axis=self.x_axis),
-                 DataFromPlugins(name='Topo', data=[np.array([0])],
-                                 dim='Data0D', labels=['Topo'])])     
+            data = [DataFromPlugins(name='ODMR',
+                                    data=[np.zeros(len(self.x_axis['data'])) for _ in labels],
+                                    dim='Data1D', labels=labels,
+                                    x_axis=self.x_axis)]
+            if self.settings.child("acq_settings", "reference_settings",
+                                   "interleaved").value():
+                contrast_labels = self.contrast_labels()
+                data.append(DataFromPlugins(
+                    name='Contrast',
+                    data=[np.zeros(len(self.x_axis['data'])) for _ in contrast_labels],
+                    dim='Data1D', labels=contrast_labels, x_axis=self.x_axis))
+            data.append(DataFromPlugins(name='Topo', data=[np.array([0])],
+                                        dim='Data0D', labels=['Topo']))
+            if self.quality is not None:
+                data.append(DataFromPlugins(name='Quality',
+                                            data=[np.array([0.]) for _ in QUALITY_LABELS],
+                                            dim='Data0D', labels=QUALITY_LABELS))
+            self.data_grabed_signal_temp.emit(data)
         return info, initialized
 
     def close(self):
         """Terminate the communication protocol"""
-        self.mw_controller.close_communication()
-        self.counter_controller["clock"].close()
-        self.counter_controller["counter"].close()
-        self.counter_controller["ai"].close()
+        self.live_stop.set()
+        self.emission.stop()
+        if self.live_thread is not None:
+            self.live_thread.join()
+            self.live_thread = None
+        self.saving.stop(flush=True)
+        self.controller.close()
         
     def grab_data(self, Naverage=1, **kwargs):
         """Start a grab from the detector
@@ -222,105 +405,229 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
         kwargs: dict
             others optionals arguments
         """
-        update = True  # to decide if we do the initial set up or not
-        self.commit_settings(self.settings.child("acq_settings", "sweep"))
-        if self.sweep_mode:
-            self.mw_controller.reset_sweep_position()
-        else:
-            self.mw_controller.reset_list_position()
-        
+        interleaved = self.settings.child("acq_settings", "reference_settings",
+                                          "interleaved").value()
+        if not interleaved:
+            self.commit_settings(self.settings.child("acq_settings", "sweep"))
         if 'live' in kwargs:
-            if kwargs['live'] == self.live and self.live:
-                update = False  # we are already live
             self.live = kwargs['live']
 
-        odmr_length = len(self.x_axis["data"])
-
-        if not update:
-             self.configure_tasks()
-             self.connect_channels()
-             self.mw_controller.sweep_on()
-        else:
-            self.update_tasks()
-            if self.sweep_mode:
-                self.mw_controller.set_sweep(start=self.start_f, stop=self.stop_f,
-                                             step=self.step_f,
-                                             power=Q_(self.settings.child("mwsettings", "power").value(),
-                                                      ureg.dBm))
-                self.mw_controller.sweep_on()
-            else:
-                self.emit_status(ThreadCommand('Update_Status',
-                                               ['List mode not supported yet']))
-                return
-
-        # synchrone version (blocking function)
-        # set timing for odmr clock task to the number of pixels
-        self.counter_controller["clock"].stop()  # to ensure that the clock is available
-        self.counter_controller["clock"].task.CfgImplicitTiming(DAQmx_Val_FiniteSamps,
-                                                                odmr_length+1)
-        # set timing for odmr count task to the number of pixels
-        self.counter_controller["counter"].task.CfgImplicitTiming(DAQmx_Val_ContSamps,
-                # count twice for each voltage +1 for starting this task.
-                # This first pulse will start the count task.
-                                                                  2*(odmr_length+1))
-        # read samples from beginning of acquisition, do not overwrite
-        self.counter_controller["counter"].task.SetReadRelativeTo(DAQmx_Val_CurrReadPos)
-        # do not read first sample
-        self.counter_controller["counter"].task.SetReadOffset(0)
-        # unread data in buffer will be overwritten
-        self.counter_controller["counter"].task.SetReadOverWrite(DAQmx_Val_DoNotOverwriteUnreadSamps)
-        # Topo analog input
-        self.counter_controller["ai"].task.CfgSampClkTiming('/' + self.clock_channel.name + "InternalOutput",
-                                                            self.clock_channel.clock_frequency,
-                                                            DAQmx_Val_Rising, DAQmx_Val_ContSamps,
-                                                            odmr_length+1)
-        try:
-            self.counter_controller["ai"].start()
-            self.counter_controller["counter"].start()
-        except Exception as e:
-            print(e)
+        # the reference points are set in list mode
+        if self.list_mode and not interleaved:
             self.emit_status(ThreadCommand('Update_Status',
-                                               ['Cannot start ODMR counter']))
+                                           ['List mode not supported yet']))
             return
 
+        if self.settings.child("emission_settings", "async_emission").value():
+            self.emission.start()
+        if self.live:
+            # the sweeps are acquired by live_loop until stop, while the
+            # emission worker processes the previous ones
+            if self.live_thread is None or not self.live_thread.is_alive():
+                self.live_stop.clear()
+                self.live_thread = threading.Thread(target=self.live_loop,
+                                                    name="ODMR_live", daemon=True)
+                self.live_thread.start()
+        else:
+            if self.quality is not None:
+                # each point of a scan is judged on its own sweeps
+                self.update_quality_monitor()
+            self.grab_sweep()
+
+    def live_loop(self):
+        """Acquire and push sweeps until stop is called."""
+        if isinstance(self.controller, ODMRProcess):
+            # the acquisition process runs ahead, grab only reads its sweeps
+            self.update_config()
+            self.controller.start_live()
+        while not self.live_stop.is_set():
+            try:
+                self.grab_sweep()
+            except Exception as e:
+                self.emit_status(ThreadCommand('Update_Status', [str(e), 'log']))
+                break
+
+    def grab_sweep(self):
+        """Acquire one sweep and push it to the emission worker, or emit it
+        directly if the emission is synchronous.
+
+        Out of live mode, the sweep is processed here and acquired again
+        (up to max_regrabs times) if the quality monitor rejects it.
+        """
+        if not self.live:
+            # a single grab waits for its data anyway
+            nb_grabs = 1
+            if self.quality is not None:
+                nb_grabs += self.settings.child("quality_settings", "max_regrabs").value()
+            for ind in range(nb_grabs):
+                # the last sweep is emitted even if rejected, so that a scan carries on
+                data = self.process_sweep(self.acquire_sweep(),
+                                          skip_rejected=ind < nb_grabs - 1)
+                if data is not None:
+                    break
+            self.data_grabed_signal.emit(data)
+        elif self.settings.child("emission_settings", "async_emission").value():
+            # the processing and the emission are done by the worker thread
+            if not self.emission.put(self.acquire_sweep()):
+                self.settings.child("emission_settings", "dropped").setValue(
+                    self.emission.dropped)
+        else:
+            data = self.process_sweep(self.acquire_sweep())
+            if data is not None:
+                self.data_grabed_signal.emit(data)
+
+    def acquire_sweep(self):
+        """Acquire one sweep and push it to the saving worker.
+
+        Returns
+        -------
+        RawSweep: the sweep, with its Axis
+        """
+        self.update_x_axis()
+        self.update_config()
         try:
-            timeout = 10
-            self.counter_controller["clock"].start()
-            self.counter_controller["clock"].task.WaitUntilTaskDone(timeout*2*odmr_length)
-        except Exception as e:
-            print(e)
-            self.emit_status(ThreadCommand('Update_Status',
-                                               ['Cannot start ODMR clock']))
-            return
+            # the MW source is only programmed again if the sweep plan changed
+            sweep = self.controller.grab(update=False)
+        except SweepFailed as e:
+            self.settings.child("error_settings", "failed").setValue(
+                len(self.controller.failed_sweeps))
+            self.emit_status(ThreadCommand('Update_Status', [str(e)]))
+            # emit NaNs so that a scan carries on, the point is marked as failed
+            sweep = self.controller.failed_sweep()
+        self.settings.child("ni_settings", "setup_time").setValue(
+            1000*self.controller.setup_time)
+        if sweep.x_axis is self.x_axis_frequencies:
+            sweep = sweep._replace(x_axis=self.x_axis)
+        else:
+            # acquired before a change of the settings
+            sweep = sweep._replace(x_axis=Axis(data=sweep.x_axis, label="Frequency",
+                                               units="MHz"))
 
-        time_per_point = self.settings.child("counter_settings",
-                                                     "counting_time").value()/1000
-        acq_time = odmr_length * time_per_point
-     
-        
-        read_data = self.counter_controller["counter"].readCounter(2*odmr_length+1,
-                                                    counting_time=acq_time, read_function="")
-        # add up adjoint pixels to also get the counts from the low time of the clock
-        data_pl = read_data[:-1:2]
-        data_pl += read_data[1:-1:2]
-        # we need to divide by the measurement time to get the PL rate!
-        data_pl = 1e-3*data_pl/time_per_point # we show kcts/s
-        
-        data_topo = self.counter_controller["ai"].readAnalog(1, ClockSettings(
-            frequency=self.clock_channel.clock_frequency,
-            Nsamples=odmr_length))
-        
-        self.data_grabed_signal.emit([DataFromPlugins(name='ODMR', data=[data_pl],
-                                                      dim='Data1D', labels=['PL (kcts/s)'],
-                                                      x_axis=self.x_axis),
-                                      DataFromPlugins(name='Topo', data=[np.array([np.mean(data_topo)])],
-                                                      dim='Data0D', labels=["Topo (nm)"])])
+        full_writer = self.full_writer
+        if full_writer is not None:
+            # saved from here since the emission may drop sweeps
+            self.saving.start()
+            self.saving.put((full_writer, sweep))
+        return sweep
+
+    def process_sweep(self, sweep, skip_rejected=True):
+        """Build the data to emit from the raw buffers of a sweep.
+
+        Parameters
+        ----------
+        sweep: RawSweep
+            Raw data read from the NI card.
+        skip_rejected: bool
+            If True, nothing is returned for a sweep rejected by the quality
+            monitor, so that it does not enter the average of the viewer.
+
+        Returns
+        -------
+        list of DataFromPlugins, or None if the sweep is skipped
+        """
+        data_pl, data_contrast = sweep_to_pl(sweep, correction=self.dead_time_correction)
+        labels = self.pl_labels(len(sweep.extra_counts), sweep.reference is not None)
+
+        frequencies = sweep.x_axis["data"]
+        quality = self.quality
+        data_quality = None
+        if quality is not None:
+            data_pl, data_quality, accepted = self.check_quality(quality, sweep, data_pl)
+            if skip_rejected and not accepted:
+                return None
+        x_axis = sweep.x_axis
+        if self.decimation != "none" and len(frequencies) > self.max_points:
+            # the display only gets max_points points, whatever the sweep length
+            frequencies, data_pl = decimate(frequencies, data_pl, self.max_points,
+                                            self.decimation)
+            data_contrast = decimate(sweep.x_axis["data"], data_contrast, self.max_points,
+                                     self.decimation)[1]
+            x_axis = Axis(data=frequencies, label="Frequency", units="MHz")
+
+        data = [DataFromPlugins(name='ODMR', data=data_pl,
+                                dim='Data1D', labels=labels,
+                                x_axis=x_axis)]
+        if sweep.interleaved:
+            data.append(DataFromPlugins(name='Contrast', data=data_contrast,
+                                        dim='Data1D',
+                                        labels=self.contrast_labels(len(sweep.extra_counts)),
+                                        x_axis=x_axis))
+        data.append(DataFromPlugins(name='Topo', data=[topo_mean(sweep.topo)],
+                                    dim='Data0D', labels=["Topo (nm)"]))
+        if data_quality is not None:
+            data.append(data_quality)
+        return data
+
+    def full_resolution_data(self, item):
+        """Compute the full resolution channels to save, in the saving
+        worker thread.
+
+        Parameters
+        ----------
+        item: tuple
+            The FullResolutionWriter and the RawSweep.
+        """
+        full_writer, sweep = item
+        data_pl, data_contrast = sweep_to_pl(sweep, correction=self.dead_time_correction)
+        return full_writer, sweep.x_axis["data"], data_pl + data_contrast
+
+    def write_full_resolution(self, data):
+        full_writer, frequencies, channels = data
+        full_writer.write(frequencies, channels)
+
+    def check_quality(self, quality, sweep, data_pl):
+        """Compute the quality metrics of the main PL channel.
+
+        The spikes of an accepted sweep are removed if required, and the
+        live grab is stopped once the average reached the target SNR.
+
+        Parameters
+        ----------
+        quality: QualityMonitor
+        sweep: RawSweep
+        data_pl: list of ndarray
+            PL channels computed by sweep_to_pl.
+
+        Returns
+        -------
+        list of ndarray: PL channels to emit
+        DataFromPlugins: the metrics
+        bool: False if the sweep is rejected
+        """
+        target_reached = quality.target_reached
+        metrics, clean_pl = quality.update(data_pl[0], sweep.time_per_point)
+        remove_spikes = self.settings.child("quality_settings", "remove_spikes").value()
+        if metrics.accepted and remove_spikes:
+            data_pl = [clean_pl] + data_pl[1:]
+        self.settings.child("quality_settings", "nb_sweeps").setValue(quality.nb_sweeps)
+        self.settings.child("quality_settings", "rejected").setValue(quality.rejected)
+        if quality.target_reached and not target_reached:
+            self.emit_status(ThreadCommand('Update_Status',
+                                           [f'SNR of {metrics.snr:.1f} reached after '
+                                            f'{quality.nb_sweeps} sweeps']))
+            if self.live:
+                self.emit_status(ThreadCommand('stop'))
+        return data_pl, DataFromPlugins(
+            name='Quality', data=[np.array([value], dtype=float) for value in metrics],
+            dim='Data0D', labels=QUALITY_LABELS), \
+            metrics.accepted
 
     def stop(self):
         """Stop the current grab hardware wise if necessary."""
-        for daq_str in self.counter_controller.keys():
-            self.counter_controller[daq_str].close()
-        self.mw_controller.off()
+        self.live_stop.set()
+        # unblock the live thread if it waits for a free slot in the queue
+        self.emission.stop()
+        if self.live_thread is not None:
+            # the current sweep is completed
+            self.live_thread.join()
+            self.live_thread = None
+        self.saving.stop(flush=True)
+        self.settings.child("emission_settings", "dropped").setValue(self.emission.dropped)
+        if self.quality is not None:
+            # the next grab starts a new average
+            self.update_quality_monitor()
+        # the tasks are only stopped, they are kept for the next grab
+        self.controller.stop()
         self.emit_status(ThreadCommand('Update_Status', ['Acquisition stopped']))
         return ''
 
@@ -328,68 +635,139 @@ class DAQ_1DViewer_ODMR(DAQ_Viewer_base):
         """Create the frequency list for the ODMR measurement."""
         if self.nb_ranges == 1:
             # we can use the sweep mode.
-            freqs = np.arange(self.start_f.to(ureg.MHz).magnitude,
-                              (self.stop_f + self.step_f).to(ureg.MHz).magnitude,
-                              self.step_f.to(ureg.MHz).magnitude, dtype=np.float32)
-            self.x_axis = Axis(data=freqs, label="Frequency", units="MHz")
+            # only the axis, the MW list is built by the controller
+            frequencies = sweep_axis(self.start_f.to(ureg.MHz).magnitude,
+                                     self.stop_f.to(ureg.MHz).magnitude,
+                                     self.step_f.to(ureg.MHz).magnitude)
+            if frequencies is not self.x_axis_frequencies:
+                self.x_axis = Axis(data=frequencies, label="Frequency", units="MHz")
+                self.x_axis_frequencies = frequencies
         else:
             self.emit_status(ThreadCommand('Update_Status',
                                            ['Several ranges not supported yet']))
 
-    def update_tasks(self):
-        """Set up the counting tasks synchronized with the MW source
-        in the NI card."""
-        
-        self.update_x_axis()
+    def update_config(self):
+        """Copy the values of the settings into the configuration of
+        the controller."""
+        extra_counters = []
+        for task_name in self.extra_counter_names():
+            counter_settings = self.settings.child("counter_settings", "extra_counters",
+                                                   task_name)
+            extra_counters.append(dict(
+                counter_channel=counter_settings.child("counter_channel").value(),
+                photon_channel=counter_settings.child("photon_channel").value(),
+                reference=counter_settings.child("reference").value()))
+        ref_settings = self.settings.child("acq_settings", "reference_settings")
+        with self.controller.lock:
+            self.controller.config.update(
+                address=self.settings.child("mwsettings", "address").value(),
+                power=self.settings.child("mwsettings", "power").value(),
+                counting_time=self.settings.child("counter_settings",
+                                                  "counting_time").value(),
+                counter_channel=self.settings.child("counter_settings",
+                                                    "counter_channel").value(),
+                photon_channel=self.settings.child("counter_settings", "source_settings",
+                                                   "photon_channel").value(),
+                extra_counters=extra_counters,
+                clock_channel=self.settings.child("ni_settings", "clock_channel").value(),
+                topo_channel=self.settings.child("ni_settings", "topo_channel").value(),
+                sync_channel=self.settings.child("ni_settings", "sync_channel").value(),
+                start_f=self.start_f.to(ureg.MHz).magnitude,
+                stop_f=self.stop_f.to(ureg.MHz).magnitude,
+                step_f=self.step_f.to(ureg.MHz).magnitude,
+                sweep_mode=self.sweep_mode,
+                interleaved=ref_settings.child("interleaved").value(),
+                ref_f=ref_settings.child("ref_f").value(),
+                ref_power=ref_settings.child("ref_power").value(),
+                attempts=self.settings.child("error_settings", "attempts").value(),
+                backoff=self.settings.child("error_settings", "backoff").value()/1000,
+                concurrent_setup=self.settings.child("ni_settings",
+                                                     "concurrent_setup").value())
 
-        # Create channels
-        self.create_channels()
-        # configure tasks
-        self.configure_tasks()
-        # connect everything
-        self.connect_channels()
-
-    def create_channels(self):
-        """ Create the channels in the NI card to update the tasks."""
-        clock_freq = 1.0 / (self.settings.child("counter_settings", "counting_time").value()/1000)
-        self.clock_channel = ClockCounter(clock_freq, name=self.settings.child("ni_settings",
-                                          "clock_channel").value(), source="Counter")
-        
-        self.counter_channel = SemiPeriodCounter(5e6, name=self.settings.child("counter_settings",
-                                                 "counter_channel").value(), source="Counter")
-        #self.counter_channel.name = '/'+self.counter_channel.name
-        
-        self.topo_channel = AIChannel(name=self.settings.child("ni_settings",
-                                      "topo_channel").value(), source="Analog_Input")
-
-    def configure_tasks(self):
-        """ Configure the tasks in the NI card, by calling the update functions of each controller."""
-        self.counter_controller["clock"].update_task(channels=[self.clock_channel],
-                                                     # do not configure clock yet, so Nsamples=1
-                                                     clock_settings=ClockSettings(Nsamples=1),
-                                                     trigger_settings=TriggerSettings())
-        self.counter_controller["counter"].update_task(channels=[self.counter_channel],
-                                                       clock_settings=ClockSettings(Nsamples=1),
-                                                       trigger_settings=TriggerSettings())
-        self.counter_controller["ai"].update_task(channels=[self.topo_channel],
-                                                       clock_settings=ClockSettings(Nsamples=1),
-                                                       trigger_settings=TriggerSettings())
-
-    def connect_channels(self):
-        """ Connect together the channels for synchronization."""
-        # connect the pulses from the clock to the counter
-        self.counter_controller["counter"].task.SetCISemiPeriodTerm(
-            self.counter_channel.name, '/'+self.clock_channel.name + "InternalOutput")
-        # define the source of ticks for the counter as self._photon_source
-        self.counter_controller["counter"].task.SetCICtrTimebaseSrc(
-            self.counter_channel.name, self.settings.child("counter_settings",
-                                                           "source_settings", "photon_channel").value())
-        # connect the clock to the trigger channel to give triggers for the microwave
-        DAQmxConnectTerms("/" + self.clock_channel.name + "InternalOutput",
-                          self.settings.child("ni_settings", "sync_channel").value(),
-                          DAQmx_Val_DoNotInvertPolarity)
+    def extra_counter_names(self):
+        """Names of the settings groups of the extra counters."""
+        nb_counters = self.settings.child("counter_settings", "extra_counters",
+                                          "nb_counters").value()
+        return [f"counter{ind}" for ind in range(1, nb_counters+1)]
+
+    def reference_index(self):
+        """Index of the extra counter used as reference for the normalized
+        PL, None if there is no reference."""
+        for ind, task_name in enumerate(self.extra_counter_names()):
+            if self.settings.child("counter_settings", "extra_counters",
+                                   task_name, "reference").value():
+                return ind
+        return None
+
+    def pl_labels(self, nb_extra=None, normalized=None):
+        """Labels of the channels of the emitted ODMR data."""
+        if nb_extra is None:
+            nb_extra = len(self.extra_counter_names())
+        if normalized is None:
+            normalized = self.reference_index() is not None
+        labels = ['PL (kcts/s)'] + [f'PL counter {ind} (kcts/s)'
+                                    for ind in range(1, nb_extra+1)]
+        if normalized:
+            labels.append('Normalized PL (kcts/s)')
+        return labels
+
+    def contrast_labels(self, nb_extra=None):
+        """Labels of the channels of the emitted contrast data, one per
+        counter."""
+        if nb_extra is None:
+            nb_extra = len(self.extra_counter_names())
+        return ['Contrast'] + [f'Contrast counter {ind}' for ind in range(1, nb_extra+1)]
+
+    def update_extra_counters(self, nb_counters):
+        """Add or remove the settings groups of the extra counters, their
+        tasks are created by the controller at the next grab."""
+        group = self.settings.child("counter_settings", "extra_counters")
+        nb_existing = len(group.children()) - 1
+        for ind in range(nb_existing+1, nb_counters+1):
+            group.addChild(extra_counter_group(ind))
+        for ind in range(nb_existing, nb_counters, -1):
+            group.removeChild(group.child(f"counter{ind}"))
+
+    def update_dead_time_correction(self):
+        """Create a new DeadTimeCorrection from the settings."""
+        settings = self.settings.child("counter_settings", "dead_time_settings")
+        self.dead_time_correction = DeadTimeCorrection(
+            model=settings.child("dead_time_model").value(),
+            dead_time=1e-9*settings.child("dead_time").value())
+
+    def update_full_writer(self):
+        """Create a FullResolutionWriter if the full spectra are saved."""
+        folder = self.settings.child("emission_settings", "full_folder").value()
+        if self.settings.child("emission_settings", "save_full").value() and folder:
+            self.full_writer = FullResolutionWriter(folder)
+        else:
+            self.full_writer = None
+
+    def update_processing(self):
+        """Apply the processing and emission settings, which may have been
+        restored from a preset without being committed."""
+        self.update_dead_time_correction()
+        settings = self.settings.child("emission_settings")
+        self.emission.maxsize = settings.child("queue_size").value()
+        self.emission.policy = settings.child("overflow_policy").value()
+        self.decimation = settings.child("decimation").value()
+        self.max_points = settings.child("max_points").value()
+        self.update_full_writer()
+        self.update_quality_monitor()
+
+    def update_quality_monitor(self):
+        """Create a new QualityMonitor from the settings, which also starts
+        a new average."""
+        settings = self.settings.child("quality_settings")
+        if settings.child("metrics").value():
+            self.quality = QualityMonitor(
+                clip_sigma=settings.child("clip_sigma").value(),
+                max_outliers=settings.child("max_outliers").value(),
+                max_drift=settings.child("max_drift").value()/100,
+                snr_target=settings.child("snr_target").value())
+        else:
+            self.quality = None
         
         
 if __name__ == '__main__':
     main(__file__)
-
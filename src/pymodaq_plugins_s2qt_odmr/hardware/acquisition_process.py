@@ -0,0 +1,446 @@
+""" Run the ODMRController in a separate process, so that the timing of
+the hardware is not affected by the load of the dashboard (plotting,
+fitting...). The sweeps come back through a ring of shared memory slots,
+only small control messages go through the pipes.
+
+When live, the acquisition process acquires sweeps continuously and
+only sends the index of the slot holding each of them: the dashboard
+process consumes them at its own pace.
+"""
+import multiprocessing
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_controller import ODMRController, \
+    default_config
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import RawSweep
+from pymodaq_plugins_s2qt_odmr.hardware.sweep_plan import sweep_plan, sweep_axis
+from pymodaq_plugins_s2qt_odmr.hardware.errors import SweepFailed
+
+
+def _write_sweep(sweep, buffer):
+    """Copy the buffers of a sweep into a shared memory block, allocating
+    a new one if the size changed.
+
+    Returns
+    -------
+    SharedMemory: the block holding the sweep
+    dict: message describing the layout of the block and the sweep
+    """
+    arrays = [sweep.counts] + list(sweep.extra_counts) + [sweep.topo]
+    size = sum(len(array) for array in arrays) * np.dtype(np.float64).itemsize
+    if buffer is None or buffer.size < size:
+        if buffer is not None:
+            buffer.close()
+            buffer.unlink()
+        buffer = shared_memory.SharedMemory(create=True, size=size)
+    data = np.ndarray((size // 8,), dtype=np.float64, buffer=buffer.buf)
+    offset = 0
+    for array in arrays:
+        data[offset:offset+len(array)] = array
+        offset += len(array)
+    return buffer, dict(name=buffer.name, counts_length=len(sweep.counts),
+                        nb_extra=len(sweep.extra_counts), topo_length=len(sweep.topo),
+                        time_per_point=sweep.time_per_point, reference=sweep.reference,
+                        interleaved=sweep.interleaved)
+
+
+def _send_error(conn, error):
+    """Send an exception to the other process, as ("error", exception)."""
+    try:
+        conn.send(("error", error))
+    except Exception:
+        # exception which cannot be pickled
+        conn.send(("error", RuntimeError(f"{type(error).__name__}: {error}")))
+
+
+def _plan_args(config):
+    """Arguments of sweep_plan for a configuration, sent with each sweep so
+    that its frequencies are known even if the configuration changed since."""
+    return ((config.start_f, config.stop_f, config.step_f, config.power),
+            dict(interleaved=config.interleaved, ref_f=config.ref_f,
+                 ref_power=config.ref_power))
+
+
+class _AcquisitionWorker:
+    """ Main loop of the acquisition process.
+
+    The commands received on conn are answered with ("ok", result) or
+    ("error", exception). When live, the sweeps are acquired continuously,
+    the commands being handled between them, and each sweep is announced
+    on data_conn with ("sweep", layout) or ("error", exception). Any other
+    error than SweepFailed also ends the live acquisition, but the process
+    keeps answering the commands.
+
+    Parameters
+    ----------
+    conn: Connection
+        Control pipe.
+    data_conn: Connection
+        Pipe of the live sweeps, towards the dashboard process.
+    free_slots: Semaphore
+        Number of slots of the ring which were read by the dashboard process.
+    nb_slots: int
+        Number of shared memory slots of the ring.
+    """
+
+    def __init__(self, conn, data_conn, free_slots, nb_slots, config, controller_kwargs):
+        self.conn = conn
+        self.data_conn = data_conn
+        self.free_slots = free_slots
+        self.buffers = [None] * nb_slots
+        self.slot = 0
+        self.controller = ODMRController(config=config, **controller_kwargs)
+        self.live = False
+        self.running = True
+        self.dropped = 0  # live sweeps dropped since the ring was full
+
+    def run(self):
+        while self.running:
+            if self.live:
+                while self.running and self.conn.poll():
+                    self.execute(*self.conn.recv())
+                if self.live and self.running:
+                    self.acquire_live()
+            else:
+                self.execute(*self.conn.recv())
+        for buffer in self.buffers:
+            if buffer is not None:
+                buffer.close()
+                buffer.unlink()
+        self.conn.close()
+        self.data_conn.close()
+
+    def write(self, sweep):
+        """Write a sweep in the next slot of the ring, which must be free."""
+        self.buffers[self.slot], layout = _write_sweep(sweep, self.buffers[self.slot])
+        layout.update(slot=self.slot, setup_time=self.controller.setup_time,
+                      plan=_plan_args(self.controller.config), dropped=self.dropped)
+        self.slot = (self.slot + 1) % len(self.buffers)
+        return layout
+
+    def acquire_live(self):
+        """Acquire one sweep and announce it, it is dropped if the
+        dashboard process did not read the previous ones yet."""
+        try:
+            sweep = self.controller.grab(update=False)
+        except SweepFailed as e:
+            self.data_conn.send(("error", e))
+            return
+        except Exception as e:
+            # not a hardware failure (invalid settings...), it would happen
+            # again at each sweep
+            self.live = False
+            _send_error(self.data_conn, e)
+            return
+        # the acquisition never waits for the dashboard process
+        if self.free_slots.acquire(block=False):
+            self.data_conn.send(("sweep", self.write(sweep)))
+        else:
+            self.dropped += 1
+
+    def execute(self, command, args):
+        controller = self.controller
+        try:
+            if command == "grab":
+                controller.config.update(args["config"])
+                sweep = controller.grab(update=args["update"])
+                self.free_slots.acquire()
+                result = self.write(sweep)
+            elif command == "start_live":
+                controller.config.update(args)
+                self.live = True
+                result = None
+            elif command == "stop_live":
+                self.live = False
+                result = self.dropped
+            elif command == "config":
+                controller.config.update(args)
+                result = None
+            elif command == "failed_sweep":
+                controller.config.update(args["config"])
+                result = controller.failed_sweep()
+            elif command == "mw_attribute":
+                attribute = getattr(controller.mw_source, args)
+                result = ("method", None) if callable(attribute) else ("value", attribute)
+            elif command == "mw_call":
+                name, call_args, call_kwargs = args
+                result = getattr(controller.mw_source, name)(*call_args, **call_kwargs)
+            elif command == "get":
+                result = getattr(controller, args)
+            elif command == "set":
+                setattr(controller, *args)
+                result = None
+            elif command == "call":
+                name, call_args = args
+                if name in ["open", "update_tasks"]:
+                    controller.config.update(call_args)
+                    call_args = {}
+                result = getattr(controller, name)(**call_args)
+                if name == "close":
+                    self.live = False
+                    self.running = False
+            self.conn.send(("ok", result))
+        except Exception as e:
+            _send_error(self.conn, e)
+
+
+def _worker(conn, data_conn, free_slots, nb_slots, config, controller_kwargs):
+    """Entry point of the acquisition process."""
+    _AcquisitionWorker(conn, data_conn, free_slots, nb_slots, config,
+                       controller_kwargs).run()
+
+
+class _MWSourceProxy:
+    """Forward the calls to the MW source of the acquisition process."""
+
+    def __init__(self, process):
+        self._process = process
+
+    def __getattr__(self, name):
+        kind, value = self._process.request("mw_attribute", name)
+        if kind == "value":
+            return value
+
+        def method(*args, **kwargs):
+            return self._process.request("mw_call", (name, args, kwargs))
+        return method
+
+
+class ODMRProcess:
+    """ Same interface as ODMRController, the hardware being driven by
+    a separate process.
+
+    Parameters
+    ----------
+    config: dict, optional
+        Values replacing the ones of default_config.
+    nb_slots: int
+        Number of sweeps which can wait for the dashboard process when live.
+    timeout: float
+        Time (in s) to wait for the answer of the acquisition process, the
+        duration of the sweeps being added for a grab. The process is
+        terminated if it does not answer in time.
+    controller_kwargs: dict
+        Other arguments of ODMRController, they must be picklable.
+    """
+
+    def __init__(self, config=None, nb_slots=4, timeout=10., **controller_kwargs):
+        self.config = default_config()
+        if config is not None:
+            self.config.update(config)
+        # spawn, since forking a process with running threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self._data_conn, child_data_conn = context.Pipe(duplex=False)
+        self._free_slots = context.Semaphore(nb_slots)
+        self._process = context.Process(target=_worker, name="ODMR_acquisition",
+                                        args=(child_conn, child_data_conn, self._free_slots,
+                                              nb_slots, dict(self.config), controller_kwargs),
+                                        daemon=True)
+        self._process.start()
+        self._lock = threading.Lock()  # the requests may come from several threads
+        # the acquisition process handles the commands between two sweeps,
+        # this lock only groups the changes, like ODMRController.lock
+        self.lock = threading.RLock()
+        self._buffers = {}  # shared memory block opened for each slot
+        self._live_config = None  # configuration sent to the live acquisition, if live
+        self.mw_source = _MWSourceProxy(self)
+        self.timeout = timeout
+        self.setup_time = 0.
+        self.failed_sweeps = []
+        self.dropped = 0  # sweeps dropped by the live acquisition
+
+    @property
+    def alive(self):
+        """True if the acquisition process is running."""
+        return self._process.is_alive()
+
+    def request(self, command, args=None, timeout=None):
+        """Send a command to the acquisition process and wait for the result.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Time (in s) to wait for the answer, self.timeout by default.
+
+        Raises
+        ------
+        ConnectionError: if the acquisition process is not running.
+        TimeoutError: if it did not answer in time.
+        The exception raised in the acquisition process, if any.
+        """
+        with self._lock:
+            if not self.alive:
+                raise ConnectionError("The acquisition process is not running")
+            self._conn.send((command, args))
+            status, result = self._recv(self._conn, timeout)
+        if status == "error":
+            raise result
+        return result
+
+    def _recv(self, conn, timeout=None):
+        """Wait for a message of the acquisition process.
+
+        Raises
+        ------
+        ConnectionError: if the acquisition process ended.
+        TimeoutError: if no message came in time, the process is then
+            terminated since its answers would not match the next requests.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.perf_counter() + timeout
+        while not conn.poll(0.1):
+            if not self.alive:
+                # the last message may have been sent just before the end
+                if conn.poll():
+                    break
+                raise ConnectionError("The acquisition process is not running")
+            if time.perf_counter() > deadline:
+                self._process.terminate()
+                raise TimeoutError(f"No answer of the acquisition process after {timeout} s")
+        try:
+            return conn.recv()
+        except (EOFError, OSError) as e:
+            raise ConnectionError("The acquisition process is not running") from e
+
+    def sweep_timeout(self):
+        """Longest time (in s) to wait for a sweep, with all its attempts."""
+        duration = self.plan.odmr_length * self.config.counting_time / 1000
+        return self.timeout + self.config.attempts * (self.timeout + 2 * duration)
+
+    @property
+    def live(self):
+        """True if the acquisition process acquires sweeps continuously."""
+        return self._live_config is not None
+
+    @property
+    def mw_ready(self):
+        return self.request("get", "mw_ready")
+
+    @mw_ready.setter
+    def mw_ready(self, value):
+        self.request("set", ("mw_ready", value))
+
+    @property
+    def plan(self):
+        """SweepPlan of the current configuration, see ODMRController.plan."""
+        return sweep_plan(self.config.start_f, self.config.stop_f, self.config.step_f,
+                          self.config.power, interleaved=self.config.interleaved,
+                          ref_f=self.config.ref_f, ref_power=self.config.ref_power)
+
+    def frequencies(self):
+        """Frequency list of the ODMR measurement, in MHz."""
+        return self.plan.frequencies
+
+    def open(self):
+        return self.request("call", ("open", dict(self.config)))
+
+    def update_tasks(self):
+        return self.request("call", ("update_tasks", dict(self.config)))
+
+    def start_live(self):
+        """Let the acquisition process acquire sweeps continuously, they are
+        then read by grab."""
+        if not self.live:
+            self._live_config = dict(self.config)
+            self.request("start_live", self._live_config)
+
+    def stop_live(self):
+        """Stop the continuous acquisition, the sweeps not read yet are
+        discarded."""
+        if self.live:
+            self._live_config = None
+            if not self.alive:
+                return
+            self.dropped = self.request("stop_live")
+            # the sweeps announced before the answer are all in the pipe
+            while self._data_conn.poll():
+                status, result = self._data_conn.recv()
+                if status == "sweep":
+                    self._free_slots.release()
+
+    def stop(self):
+        """Stop the acquisition, nothing is left running if the acquisition
+        process ended."""
+        self.stop_live()
+        if self.alive:
+            return self.request("call", ("stop", {}))
+
+    def close(self):
+        """Close the hardware and terminate the acquisition process."""
+        try:
+            self.stop_live()
+            if self.alive:
+                self.request("call", ("close", {}))
+        finally:
+            alive = self.alive
+            for buffer in self._buffers.values():
+                buffer.close()
+                if not alive:
+                    # the acquisition process could not release its slots
+                    try:
+                        buffer.unlink()
+                    except FileNotFoundError:
+                        pass
+            self._buffers = {}
+            self._process.join(timeout=5)
+            if self.alive:
+                self._process.terminate()
+
+    def grab(self, update=True):
+        """Acquire one sweep in the acquisition process, see ODMRController.grab.
+
+        When live, return the next sweep acquired by the acquisition process,
+        the configuration being sent to it first if it changed.
+        """
+        try:
+            if self.live:
+                if dict(self.config) != self._live_config:
+                    self._live_config = dict(self.config)
+                    self.request("config", self._live_config)
+                status, layout = self._recv(self._data_conn, self.sweep_timeout())
+                if status == "error":
+                    if not isinstance(layout, SweepFailed):
+                        # the acquisition process left the live mode
+                        self._live_config = None
+                    raise layout
+            else:
+                layout = self.request("grab", dict(update=update, config=dict(self.config)),
+                                      timeout=self.sweep_timeout())
+        except SweepFailed as e:
+            self.failed_sweeps.append((time.time(), e))
+            raise
+        return self.read_sweep(layout)
+
+    def read_sweep(self, layout):
+        """Copy a sweep out of its slot, which is then free again."""
+        self.setup_time = layout["setup_time"]
+        self.dropped = layout["dropped"]
+        buffer = self._buffers.get(layout["slot"])
+        if buffer is None or buffer.name != layout["name"]:
+            if buffer is not None:
+                buffer.close()
+            buffer = shared_memory.SharedMemory(name=layout["name"])
+            self._buffers[layout["slot"]] = buffer
+        data = np.ndarray((buffer.size // 8,), dtype=np.float64, buffer=buffer.buf)
+        counts_length = layout["counts_length"]
+        # copy, the slot is written again by the next sweeps
+        arrays = [data[ind*counts_length:(ind+1)*counts_length].copy()
+                  for ind in range(layout["nb_extra"] + 1)]
+        offset = (layout["nb_extra"] + 1) * counts_length
+        topo = data[offset:offset+layout["topo_length"]].copy()
+        del data
+        self._free_slots.release()
+        start_f, stop_f, step_f, _ = layout["plan"][0]
+        return RawSweep(counts=arrays[0], topo=topo, time_per_point=layout["time_per_point"],
+                        x_axis=sweep_axis(start_f, stop_f, step_f),
+                        extra_counts=arrays[1:], reference=layout["reference"],
+                        interleaved=layout["interleaved"])
+
+    def failed_sweep(self):
+        return self.request("failed_sweep", dict(config=dict(self.config)))
@@ -0,0 +1,146 @@
+""" Producer/consumer pipeline used to take the processing and the
+emission of the ODMR data out of the acquisition thread.
+"""
+import logging
+import threading
+from collections import deque
+
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import RawSweep
+
+# child of the pymodaq logger, so that the messages reach the PyMoDAQ log
+# when it is loaded, without importing PyMoDAQ for the headless API
+logger = logging.getLogger(f"pymodaq.{__name__.rsplit('.', 1)[-1]}")
+
+OVERFLOW_POLICIES = ["drop oldest", "block"]
+
+
+class EmissionPipeline:
+    """ Bounded queue between the acquisition thread, which only pushes
+    the raw buffers, and a worker thread doing the processing and the
+    emission of the data.
+
+    Parameters
+    ----------
+    process: callable
+        Called by the worker with a RawSweep, returns the data to emit,
+        or None to skip the sweep.
+    emit: callable
+        Called by the worker with the output of process.
+    maxsize: int
+        Number of sweeps which can wait in the queue.
+    policy: str
+        What to do when the queue is full, one of OVERFLOW_POLICIES.
+        "drop oldest" never blocks the acquisition, "block" waits for
+        the worker to free a slot.
+    """
+
+    def __init__(self, process, emit, maxsize=4, policy="drop oldest"):
+        self._process = process
+        self._emit = emit
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self.maxsize = maxsize
+        self.policy = policy
+        self.pushed = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """Start the worker thread if it is not running yet."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="ODMR_emission",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1., flush=False):
+        """Stop the worker, the sweeps still in the queue are discarded
+        unless flush is True.
+
+        Parameters
+        ----------
+        timeout: float
+            Maximum time (in s) to wait for the worker to finish.
+        flush: bool
+            If True, wait for the worker to process the queued sweeps.
+        """
+        with self._cond:
+            if flush:
+                while self._queue and self._thread is not None and self._thread.is_alive():
+                    self._cond.wait(timeout)
+            self._running = False
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def reset_counters(self):
+        self.pushed = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def put(self, sweep):
+        """Push the raw data of a sweep, called from the acquisition thread.
+
+        Parameters
+        ----------
+        sweep: RawSweep
+
+        Returns
+        -------
+        bool: False if a sweep had to be dropped to make room, or if the
+            worker is stopped.
+        """
+        with self._cond:
+            if not self._running:
+                self.dropped += 1
+                return False
+            accepted = True
+            if self.policy == "block":
+                while self._running and len(self._queue) >= self.maxsize:
+                    self._cond.wait()
+                if not self._running:
+                    # stopped while waiting
+                    self.dropped += 1
+                    return False
+            elif len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+                accepted = False
+            self._queue.append(sweep)
+            self.pushed += 1
+            self._cond.notify_all()
+        return accepted
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                sweep = self._queue.popleft()
+                self._cond.notify_all()
+            try:
+                data = self._process(sweep)
+                if data is None:
+                    self.skipped += 1
+                    continue
+                self._emit(data)
+                self.emitted += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Could not process ODMR sweep: {e}")
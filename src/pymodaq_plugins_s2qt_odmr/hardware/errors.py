@@ -0,0 +1,123 @@
+""" Exceptions raised during an ODMR acquisition and helpers to recover
+from transient hardware errors without re-initializing everything.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+# child of the pymodaq logger, so that the messages reach the PyMoDAQ log
+# when it is loaded, without importing PyMoDAQ for the headless API
+logger = logging.getLogger(f"pymodaq.{__name__.rsplit('.', 1)[-1]}")
+
+
+class ODMRError(Exception):
+    """Base class of the errors of the ODMR acquisition."""
+    pass
+
+
+class DAQTaskError(ODMRError):
+    """Error of a given task of the NI card.
+
+    Parameters
+    ----------
+    task_name: str
+        Key of the failed task in the counter_controller dictionary.
+    message: str
+    """
+
+    def __init__(self, task_name, message=""):
+        super().__init__(f"{task_name}: {message}")
+        self.task_name = task_name
+        self.message = message
+
+    def __reduce__(self):
+        # to be sent back by the acquisition process
+        return DAQTaskError, (self.task_name, self.message)
+
+
+class MWSourceError(ODMRError):
+    """Error of the communication with the MW source."""
+    pass
+
+
+class SweepFailed(ODMRError):
+    """Raised when a sweep could not be acquired after all the retries.
+
+    Parameters
+    ----------
+    errors: list of ODMRError
+        The error of each attempt.
+    """
+
+    def __init__(self, errors):
+        super().__init__(f"Sweep failed after {len(errors)} attempts: {errors[-1]}")
+        self.errors = errors
+
+    def __reduce__(self):
+        return SweepFailed, (self.errors,)
+
+
+@contextmanager
+def daq_task_errors(task_name):
+    """Turn any exception raised by the DAQmx calls of the block into a
+    DAQTaskError of the given task."""
+    try:
+        yield
+    except ODMRError:
+        raise
+    except Exception as e:
+        raise DAQTaskError(task_name, str(e)) from e
+
+
+@contextmanager
+def mw_errors():
+    """Turn any exception raised by the VISA calls of the block into a
+    MWSourceError."""
+    try:
+        yield
+    except ODMRError:
+        raise
+    except Exception as e:
+        raise MWSourceError(str(e)) from e
+
+
+def retry(func, attempts=3, backoff=0.1, recover=None):
+    """Call func until it succeeds, at most attempts times.
+
+    Parameters
+    ----------
+    func: callable
+        Function without argument to call.
+    attempts: int
+        Maximum number of calls.
+    backoff: float
+        Time to wait (in s) before the first retry, doubled at each retry.
+    recover: callable, optional
+        Called with the ODMRError before each retry, to reset the faulty
+        part of the hardware.
+
+    Returns
+    -------
+    The output of func.
+
+    Raises
+    ------
+    SweepFailed: if all the attempts failed.
+    """
+    errors = []
+    for attempt in range(attempts):
+        try:
+            return func()
+        except ODMRError as e:
+            errors.append(e)
+            logger.warning(f"Attempt {attempt+1}/{attempts} failed: {e}")
+            if attempt == attempts - 1:
+                break
+            time.sleep(backoff * 2**attempt)
+            if recover is not None:
+                try:
+                    recover(e)
+                except ODMRError as recover_error:
+                    errors.append(recover_error)
+                    logger.warning(f"Recovery failed: {recover_error}")
+    raise SweepFailed(errors)
@@ -0,0 +1,485 @@
+""" Control of the MW source and of the NI card counters to acquire
+ODMR sweeps. This object does not depend on the PyMoDAQ GUI, it is used
+both by the DAQ_1DViewer_ODMR plugin and by the headless API.
+"""
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from easydict import EasyDict as edict
+from pymodaq_plugins_rohdeschwarz.hardware.SMA_SMB_MW_sources import MWsource
+from pymodaq_plugins_daqmx.hardware.national_instruments.daqmx import DAQmx, \
+    ClockSettings, ClockCounter, SemiPeriodCounter, TriggerSettings, AIChannel
+from PyDAQmx import DAQmxConnectTerms, DAQmx_Val_DoNotInvertPolarity, \
+     DAQmx_Val_ContSamps, DAQmx_Val_FiniteSamps, DAQmx_Val_CurrReadPos, \
+     DAQmx_Val_DoNotOverwriteUnreadSamps, DAQmx_Val_Rising
+from pymodaq_plugins_s2qt_odmr import ureg, Q_
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import RawSweep
+from pymodaq_plugins_s2qt_odmr.hardware.sweep_plan import sweep_plan
+from pymodaq_plugins_s2qt_odmr.hardware.errors import DAQTaskError, MWSourceError, \
+    SweepFailed, daq_task_errors, mw_errors, retry
+
+
+def default_config():
+    """Configuration of an ODMR acquisition, frequencies are in MHz,
+    powers in dBm and the counting time in ms.
+
+    extra_counters is a list of dictionaries with the keys counter_channel,
+    photon_channel and reference, for the counters gated by the same clock
+    as the main one.
+    """
+    return edict(address="", power=0., counting_time=100.,
+                 counter_channel="", photon_channel="", extra_counters=[],
+                 clock_channel="", topo_channel="", sync_channel="",
+                 start_f=2820., stop_f=2920., step_f=2., sweep_mode=True,
+                 interleaved=False, ref_f=2500., ref_power=-145.,
+                 attempts=3, backoff=0.1, concurrent_setup=True)
+
+# keys of the configuration the NI tasks depend on
+TASK_SETTINGS = ["counting_time", "counter_channel", "photon_channel", "extra_counters",
+                 "clock_channel", "topo_channel", "sync_channel"]
+
+
+class ODMRController:
+    """ MW source driven by the clock of a NI card, which also gates the
+    photon counters and the topography analog input.
+
+    The sweeps hold lock, the other threads must also hold it to drive the
+    MW source or to change the configuration, so that these changes happen
+    between two sweeps.
+
+    Parameters
+    ----------
+    config: dict, optional
+        Values replacing the ones of default_config.
+    mw_source: object, optional
+        MW source with the interface of MWsource, a new MWsource by default.
+    daq_factory: callable, optional
+        Called without argument to create each NI task, DAQmx by default.
+    """
+
+    def __init__(self, config=None, mw_source=None, daq_factory=DAQmx):
+        self.config = default_config()
+        if config is not None:
+            self.config.update(config)
+        self.mw_source = mw_source if mw_source is not None else MWsource()
+        self._daq_factory = daq_factory
+        self.daq = {"clock": daq_factory(), "counter": daq_factory(), "ai": daq_factory()}
+
+        self.clock_channel = None
+        self.counter_channel = None
+        self.topo_channel = None
+        self.extra_counter_channels = {}
+        self.mw_ready = False  # True when the MW source is programmed for the sweep
+        self.mw_plan = None  # plan the MW source is programmed for
+        self.tasks_ready = False  # True when the NI tasks are configured
+        self.task_config = None  # values of TASK_SETTINGS the tasks are configured for
+        self.failed_sweeps = []  # (time, error) of the sweeps which could not be acquired
+        self.setup_time = 0.  # duration (in s) of the last setup before the clock starts
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ODMR_setup")
+        self.lock = threading.RLock()
+
+    def open(self):
+        """Open the communication with the MW source and configure the
+        NI tasks.
+
+        Returns
+        -------
+        bool: True if the MW source answered.
+        """
+        with self.lock:
+            initialized = self.mw_source.open_communication(address=self.config.address)
+            self.update_tasks()
+        return initialized
+
+    def close(self):
+        with self.lock:
+            self._executor.shutdown(wait=False)
+            self.mw_source.close_communication()
+            for daq_str in self.daq.keys():
+                self.daq[daq_str].close()
+
+    def stop(self):
+        """Stop the NI tasks, they are kept for the next sweep, and switch
+        off the MW."""
+        with self.lock:
+            for daq_str in self.daq.keys():
+                self.daq[daq_str].stop()
+            self.mw_source.off()
+
+    @property
+    def plan(self):
+        """SweepPlan of the current configuration, computed only once for
+        given settings."""
+        return sweep_plan(self.config.start_f, self.config.stop_f, self.config.step_f,
+                          self.config.power, interleaved=self.config.interleaved,
+                          ref_f=self.config.ref_f, ref_power=self.config.ref_power)
+
+    def frequencies(self):
+        """Frequency list of the ODMR measurement, in MHz."""
+        return self.plan.frequencies
+
+    @property
+    def odmr_length(self):
+        """Number of MW points of a sweep, including the reference points."""
+        return self.plan.odmr_length
+
+    @property
+    def time_per_point(self):
+        """Counting time per point, in s."""
+        return self.config.counting_time/1000
+
+    def extra_counter_names(self):
+        """Names of the tasks of the extra counters in daq."""
+        return [f"counter{ind}" for ind in range(1, len(self.config.extra_counters)+1)]
+
+    def counter_task_names(self):
+        """Names of all the counting tasks gated by the clock."""
+        return ["counter"] + self.extra_counter_names()
+
+    def reference_index(self):
+        """Index of the extra counter used as reference for the normalized
+        PL, None if there is no reference."""
+        for ind, counter in enumerate(self.config.extra_counters):
+            if counter["reference"]:
+                return ind
+        return None
+
+    def grab(self, update=True):
+        """Acquire one sweep, retrying after a targeted recovery if the
+        hardware fails.
+
+        Parameters
+        ----------
+        update: bool
+            If True, program the MW source again, otherwise only if the
+            sweep plan changed or after a MW error.
+
+        Returns
+        -------
+        RawSweep: the x_axis field contains the frequencies in MHz.
+
+        Raises
+        ------
+        SweepFailed: if all the attempts failed, the error is recorded
+            in failed_sweeps.
+        """
+        with self.lock:
+            if update:
+                self.mw_ready = False
+            plan = self.plan
+            try:
+                read_data, extra_counts, data_topo = retry(
+                    lambda: self.run_sweep(plan), attempts=self.config.attempts,
+                    backoff=self.config.backoff, recover=self.recover)
+            except SweepFailed as e:
+                self.failed_sweeps.append((time.time(), e))
+                raise
+            return RawSweep(counts=read_data, topo=data_topo,
+                            time_per_point=self.time_per_point, x_axis=plan.frequencies,
+                            extra_counts=extra_counts, reference=self.reference_index(),
+                            interleaved=plan.interleaved)
+
+    def failed_sweep(self):
+        """RawSweep filled with NaNs, to mark a sweep which could not be
+        acquired."""
+        plan = self.plan
+        return RawSweep(counts=np.full(plan.read_samples, np.nan),
+                        topo=np.full(plan.ai_samples, np.nan),
+                        time_per_point=self.time_per_point, x_axis=plan.frequencies,
+                        extra_counts=[np.full(plan.read_samples, np.nan)
+                                      for _ in self.extra_counter_names()],
+                        reference=self.reference_index(), interleaved=plan.interleaved)
+
+    def run_sweep(self, plan):
+        """Program the MW source and the NI tasks if needed, then acquire
+        one sweep.
+
+        Parameters
+        ----------
+        plan: SweepPlan
+
+        Returns
+        -------
+        ndarray: raw counts of the main counter
+        list of ndarray: raw counts of the extra counters
+        ndarray: topo signal
+
+        Raises
+        ------
+        DAQTaskError, MWSourceError
+        """
+        start = time.perf_counter()
+        if self.config.concurrent_setup:
+            self.setup_concurrently(plan)
+        else:
+            self.setup_tasks()
+            self.setup_mw(plan)
+        # the source is armed once the clock is routed to the sync channel,
+        # so that no glitch during the setup can step it
+        self.arm_mw(plan)
+        self.setup_time = time.perf_counter() - start
+        return self.acquire_sweep(plan)
+
+    def setup_concurrently(self, plan):
+        """Program the MW source and configure the NI tasks at the same
+        time in the executor threads, the VISA and DAQmx calls being
+        independent. Both are done when this returns.
+
+        Raises
+        ------
+        DAQTaskError, MWSourceError: the first error of the two setups.
+        """
+        futures = [self._executor.submit(self.setup_mw, plan),
+                   self._executor.submit(self.setup_tasks)]
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def setup_tasks(self):
+        """Configure the NI tasks if they are not ready or if the settings
+        they depend on changed."""
+        if not self.tasks_ready or self.current_task_config() != self.task_config:
+            self._update_tasks()
+
+    def current_task_config(self):
+        """Values of TASK_SETTINGS in the configuration."""
+        return copy.deepcopy({key: self.config[key] for key in TASK_SETTINGS})
+
+    def is_sweep_mode(self, plan):
+        """True if the MW source runs in sweep mode for this plan, False in
+        list mode."""
+        # the reference points can only be set in list mode
+        return self.config.sweep_mode and not plan.interleaved
+
+    def setup_mw(self, plan):
+        """Go back to the start of the sweep and program the MW source if it
+        is not ready for this plan."""
+        sweep_mode = self.is_sweep_mode(plan)
+        with mw_errors():
+            if sweep_mode:
+                self.mw_source.reset_sweep_position()
+            else:
+                self.mw_source.reset_list_position()
+
+            if not self.mw_ready or plan is not self.mw_plan:
+                if sweep_mode:
+                    self.mw_source.set_sweep(start=plan.start, stop=plan.stop,
+                                             step=plan.step, power=plan.power)
+                else:
+                    # the driver takes a Quantity array and a list of Quantities
+                    self.mw_source.set_list(frequency=Q_(plan.mw_frequencies, ureg.MHz),
+                                            power=list(Q_(plan.mw_powers, ureg.dBm)))
+                self.mw_ready = True
+                self.mw_plan = plan
+
+    def arm_mw(self, plan):
+        """Switch the sweep or the list of the MW source on, it then steps
+        at each trigger of the clock."""
+        with mw_errors():
+            if self.is_sweep_mode(plan):
+                self.mw_source.sweep_on()
+            else:
+                self.mw_source.list_on()
+
+    def acquire_sweep(self, plan):
+        """Configure the timing of the NI tasks, run the clock and read the
+        buffers, see run_sweep."""
+        # synchrone version (blocking function)
+        # set timing for odmr clock task to the number of pixels
+        with daq_task_errors("clock"):
+            self.daq["clock"].stop()  # to ensure that the clock is available
+            self.daq["clock"].task.CfgImplicitTiming(DAQmx_Val_FiniteSamps, plan.clock_samples)
+        for task_name in self.counter_task_names():
+            with daq_task_errors(task_name):
+                # set timing for odmr count task to the number of pixels
+                self.daq[task_name].task.CfgImplicitTiming(DAQmx_Val_ContSamps,
+                        # count twice for each voltage +1 for starting this task.
+                        # This first pulse will start the count task.
+                                                           plan.counter_samples)
+                # read samples from beginning of acquisition, do not overwrite
+                self.daq[task_name].task.SetReadRelativeTo(DAQmx_Val_CurrReadPos)
+                # do not read first sample
+                self.daq[task_name].task.SetReadOffset(0)
+                # unread data in buffer will be overwritten
+                self.daq[task_name].task.SetReadOverWrite(DAQmx_Val_DoNotOverwriteUnreadSamps)
+        # Topo analog input
+        with daq_task_errors("ai"):
+            self.daq["ai"].task.CfgSampClkTiming('/' + self.clock_channel.name + "InternalOutput",
+                                                 self.clock_channel.clock_frequency,
+                                                 DAQmx_Val_Rising, DAQmx_Val_ContSamps,
+                                                 plan.clock_samples)
+            self.daq["ai"].start()
+        for task_name in self.counter_task_names():
+            with daq_task_errors(task_name):
+                self.daq[task_name].start()
+
+        with daq_task_errors("clock"):
+            timeout = 10
+            self.daq["clock"].start()
+            self.daq["clock"].task.WaitUntilTaskDone(timeout*2*plan.odmr_length)
+
+        acq_time = plan.odmr_length * self.time_per_point
+
+        with daq_task_errors("counter"):
+            read_data = self.daq["counter"].readCounter(plan.read_samples,
+                                                        counting_time=acq_time, read_function="")
+        extra_counts = []
+        for task_name in self.extra_counter_names():
+            with daq_task_errors(task_name):
+                extra_counts.append(self.daq[task_name].readCounter(
+                    plan.read_samples, counting_time=acq_time, read_function=""))
+        with daq_task_errors("ai"):
+            data_topo = self.daq["ai"].readAnalog(1, ClockSettings(
+                frequency=self.clock_channel.clock_frequency,
+                Nsamples=plan.ai_samples))
+        # the tasks run continuously, they are stopped but kept configured
+        # so that the next sweep only sets their timing
+        for task_name in self.counter_task_names() + ["ai"]:
+            with daq_task_errors(task_name):
+                self.daq[task_name].stop()
+        return read_data, extra_counts, data_topo
+
+    def recover(self, error):
+        """Stop all the NI tasks of the sweep and reset only the part of the
+        hardware which raised the error, before acquiring the sweep again.
+
+        The failed attempt may have left tasks running, which DAQmx refuses
+        to configure or to start again.
+
+        Parameters
+        ----------
+        error: ODMRError
+        """
+        failed_tasks = []
+        if isinstance(error, DAQTaskError):
+            failed_tasks.append(error.task_name)
+        for task_name in self.daq.keys():
+            try:
+                with daq_task_errors(task_name):
+                    self.daq[task_name].stop()
+            except DAQTaskError:
+                # a task which cannot even be stopped is configured again
+                if task_name not in failed_tasks:
+                    failed_tasks.append(task_name)
+        if isinstance(error, MWSourceError):
+            # reopen the VISA link, the source will be programmed again
+            self.mw_ready = False
+            with mw_errors():
+                self.mw_source.close_communication()
+                self.mw_source.open_communication(address=self.config.address)
+        if self.tasks_ready:
+            try:
+                for task_name in failed_tasks:
+                    self.reset_task(task_name)
+            except DAQTaskError:
+                # the tasks will all be configured again
+                self.tasks_ready = False
+                raise
+        # if the tasks were not ready, they will all be configured again
+
+    def update_tasks(self):
+        """Set up the counting tasks synchronized with the MW source
+        in the NI card."""
+        with self.lock:
+            self._update_tasks()
+
+    def _update_tasks(self):
+        """update_tasks without the lock, for the setup of a sweep which
+        may run in an executor thread while the sweep holds it."""
+        self.tasks_ready = False
+        self.update_counter_tasks()
+        # Create channels
+        self.create_channels()
+        # configure tasks
+        self.configure_tasks()
+        # connect everything
+        self.connect_channels()
+        self.task_config = self.current_task_config()
+        self.tasks_ready = True
+
+    def update_counter_tasks(self):
+        """Create or close the tasks of the extra counters to match the
+        configuration."""
+        names = self.extra_counter_names()
+        for task_name in names:
+            if task_name not in self.daq:
+                self.daq[task_name] = self._daq_factory()
+        for task_name in list(self.daq.keys()):
+            if task_name.startswith("counter") and task_name != "counter" \
+                    and task_name not in names:
+                self.daq.pop(task_name).close()
+
+    def create_channels(self):
+        """ Create the channels in the NI card to update the tasks."""
+        clock_freq = 1.0 / self.time_per_point
+        self.clock_channel = ClockCounter(clock_freq, name=self.config.clock_channel,
+                                          source="Counter")
+
+        self.counter_channel = SemiPeriodCounter(5e6, name=self.config.counter_channel,
+                                                 source="Counter")
+        self.extra_counter_channels = {
+            task_name: SemiPeriodCounter(5e6, name=counter["counter_channel"], source="Counter")
+            for task_name, counter in zip(self.extra_counter_names(),
+                                          self.config.extra_counters)}
+
+        self.topo_channel = AIChannel(name=self.config.topo_channel, source="Analog_Input")
+
+    def task_channels(self):
+        """Channel of each task of daq."""
+        channels = {"clock": self.clock_channel, "counter": self.counter_channel,
+                    "ai": self.topo_channel}
+        channels.update(self.extra_counter_channels)
+        return channels
+
+    def configure_tasks(self):
+        """ Configure the tasks in the NI card, by calling the update functions of each controller."""
+        for task_name, channel in self.task_channels().items():
+            with daq_task_errors(task_name):
+                self.daq[task_name].update_task(channels=[channel],
+                                                # do not configure clock yet, so Nsamples=1
+                                                clock_settings=ClockSettings(Nsamples=1),
+                                                trigger_settings=TriggerSettings())
+
+    def reset_task(self, task_name):
+        """ Close and configure again a single task, for instance after
+        a buffer overflow, without touching the other ones."""
+        with daq_task_errors(task_name):
+            self.daq[task_name].close()
+            self.daq[task_name].update_task(channels=[self.task_channels()[task_name]],
+                                            clock_settings=ClockSettings(Nsamples=1),
+                                            trigger_settings=TriggerSettings())
+        self.connect_channels([task_name])
+
+    def connect_channels(self, task_names=None):
+        """ Connect together the channels for synchronization.
+
+        Parameters
+        ----------
+        task_names: list of str, optional
+            Connect only the channels of these tasks, all of them by default.
+        """
+        if task_names is None:
+            task_names = list(self.task_channels().keys())
+        photon_channels = {"counter": self.config.photon_channel}
+        for task_name, counter in zip(self.extra_counter_names(), self.config.extra_counters):
+            photon_channels[task_name] = counter["photon_channel"]
+        for task_name in self.counter_task_names():
+            if task_name not in task_names:
+                continue
+            channel = self.task_channels()[task_name]
+            with daq_task_errors(task_name):
+                # connect the pulses from the clock to the counter
+                self.daq[task_name].task.SetCISemiPeriodTerm(
+                    channel.name, '/'+self.clock_channel.name + "InternalOutput")
+                # define the source of ticks for the counter as the photon source
+                self.daq[task_name].task.SetCICtrTimebaseSrc(
+                    channel.name, photon_channels[task_name])
+        if "clock" in task_names:
+            with daq_task_errors("clock"):
+                # connect the clock to the trigger channel to give triggers for the microwave
+                DAQmxConnectTerms("/" + self.clock_channel.name + "InternalOutput",
+                                  self.config.sync_channel,
+                                  DAQmx_Val_DoNotInvertPolarity)
@@ -0,0 +1,377 @@
+""" Processing of the raw buffers read from the NI card during an ODMR
+sweep. These functions do not depend on PyMoDAQ nor on the hardware
+so that they can run outside of the acquisition thread.
+"""
+import warnings
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# raw buffers of one sweep, as read from the NI card. reference is the
+# index in extra_counts of the counter used to normalize the PL, if any,
+# and interleaved is True if every other point is a reference point.
+RawSweep = namedtuple("RawSweep", ["counts", "topo", "time_per_point", "x_axis",
+                                   "extra_counts", "reference", "interleaved"],
+                      defaults=[(), None, False])
+
+# quality of a sweep: snr of the average of the accepted sweeps, contrast
+# of the sweep, relative drift of its baseline versus the previous
+# accepted sweeps, number of spikes and whether it was accepted
+QualityMetrics = namedtuple("QualityMetrics", ["snr", "contrast", "drift", "outliers",
+                                               "accepted"])
+
+DEAD_TIME_MODELS = ["none", "non-paralyzable", "paralyzable"]
+
+
+@lru_cache(maxsize=8)
+def _paralyzable_table(dead_time, size):
+    """Tabulate the measured rate m = n*exp(-n*tau) of a paralyzable
+    detector for true rates n up to the saturation rate 1/tau, where m
+    is maximal and monotonic. The grid is denser at low rates."""
+    true_rates = np.linspace(0, 1, size)**2 / dead_time
+    measured_rates = true_rates * np.exp(-true_rates * dead_time)
+    true_rates.flags.writeable = False
+    measured_rates.flags.writeable = False
+    return measured_rates, true_rates
+
+
+class DeadTimeCorrection:
+    """ Correct measured count rates for the dead time of the detector.
+
+    Parameters
+    ----------
+    model: str
+        One of DEAD_TIME_MODELS.
+    dead_time: float
+        Dead time of the detector, in s.
+    table_size: int
+        Number of points of the inversion table of the paralyzable model.
+    """
+
+    def __init__(self, model="none", dead_time=0., table_size=4096):
+        if model not in DEAD_TIME_MODELS:
+            raise ValueError(f"Unknown dead time model: {model}")
+        self.model = model
+        self.dead_time = dead_time
+        self.table_size = table_size
+
+    @property
+    def saturation_rate(self):
+        """Highest measurable count rate (in cts/s) for the model."""
+        if self.model == "none" or self.dead_time <= 0:
+            return np.inf
+        elif self.model == "non-paralyzable":
+            return 1 / self.dead_time
+        else:
+            return 1 / (np.e * self.dead_time)
+
+    def __call__(self, rates):
+        """Return the true count rates (in cts/s) from the measured ones.
+
+        Rates above the saturation rate are clipped to it, slightly below
+        it for the non-paralyzable model whose true rate would be infinite.
+        """
+        if self.model == "none" or self.dead_time <= 0:
+            return rates
+        if self.model == "non-paralyzable":
+            rates = np.minimum(rates, (1 - 1e-3) * self.saturation_rate)
+            # m = n/(1 + n*tau) can be inverted directly
+            return rates / (1 - rates * self.dead_time)
+        rates = np.minimum(rates, self.saturation_rate)
+        measured_rates, true_rates = _paralyzable_table(self.dead_time, self.table_size)
+        return np.interp(rates, measured_rates, true_rates)
+
+
+def counts_to_pl(read_data, time_per_point, correction=None):
+    """Convert the raw semi-period counter buffer into a PL rate.
+
+    The counter is read 2*N+1 times for a N points sweep: each clock
+    period gives a high and a low semi-period that are added up, and
+    the last sample is dropped.
+
+    Parameters
+    ----------
+    read_data: ndarray
+        Raw counts read from the counter task (2*N+1 samples).
+    time_per_point: float
+        Counting time per frequency point, in s.
+    correction: DeadTimeCorrection, optional
+        Dead time correction applied to the count rates.
+
+    Returns
+    -------
+    ndarray: the PL rate in kcts/s for each of the N points.
+    """
+    # add up adjoint pixels to also get the counts from the low time of the clock
+    data_pl = read_data[:-1:2] + read_data[1:-1:2]
+    # we need to divide by the measurement time to get the PL rate!
+    rates = data_pl / time_per_point
+    if correction is not None:
+        rates = correction(rates)
+    return 1e-3 * rates  # we show kcts/s
+
+
+def normalize_pl(data_pl, reference):
+    """Divide out the fluctuations of the excitation point by point using
+    the PL measured by a reference detector during the same sweep.
+
+    The result is rescaled by the mean reference rate to stay in kcts/s.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return data_pl * np.mean(reference) / reference
+
+
+def interleaved_contrast(data_pl):
+    """Compute the ODMR contrast from a sweep in which each frequency
+    point is followed by a reference point.
+
+    Parameters
+    ----------
+    data_pl: ndarray
+        PL of the 2*N points of the sweep, alternating signal (even indices)
+        and reference (odd indices), see sweep_plan.
+
+    Returns
+    -------
+    ndarray: signal/reference for each of the N frequencies.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return data_pl[::2] / data_pl[1::2]
+
+
+def topo_mean(data_topo):
+    """Average the topography signal acquired during the sweep."""
+    return np.array([np.mean(data_topo)])
+
+
+def sweep_to_pl(sweep, correction=None):
+    """Compute the PL channels of a sweep.
+
+    Parameters
+    ----------
+    sweep: RawSweep
+        Raw data read from the NI card.
+    correction: DeadTimeCorrection, optional
+        Dead time correction applied to the count rates.
+
+    Returns
+    -------
+    list of ndarray: PL of the main counter, of the extra counters and,
+        if there is a reference counter, the normalized PL (kcts/s).
+    list of ndarray: contrast of each counter if the sweep has reference
+        points, empty list otherwise.
+    """
+    data_pl = [counts_to_pl(counts, sweep.time_per_point, correction=correction)
+               for counts in [sweep.counts] + list(sweep.extra_counts)]
+    data_contrast = []
+    if sweep.interleaved:
+        # keep the PL on the signal points, the reference points are only
+        # used for the contrast
+        data_contrast = [interleaved_contrast(pl) for pl in data_pl]
+        data_pl = [pl[::2] for pl in data_pl]
+    if sweep.reference is not None:
+        data_pl.append(normalize_pl(data_pl[0], data_pl[sweep.reference + 1]))
+    return data_pl, data_contrast
+
+
+DECIMATION_MODES = ["none", "mean", "min/max"]
+
+
+def decimate(frequencies, data, max_points, mode="mean"):
+    """Reduce the number of points of the spectra to display.
+
+    Parameters
+    ----------
+    frequencies: ndarray
+        Frequency axis of the N points.
+    data: list of ndarray
+        Spectra of N points sharing the frequency axis.
+    max_points: int
+        Maximum number of points after decimation.
+    mode: str
+        One of DECIMATION_MODES. "mean" averages consecutive points,
+        "min/max" keeps the minimum and the maximum of each bin so
+        that narrow lines stay visible.
+
+    Returns
+    -------
+    ndarray: decimated frequency axis
+    list of ndarray: decimated spectra
+    """
+    nb_points = len(frequencies)
+    if mode == "none" or nb_points <= max_points:
+        return frequencies, data
+    # two points per bin in min/max mode
+    max_bins = max_points // 2 if mode == "min/max" else max_points
+    bin_size = int(np.ceil(nb_points / max_bins))
+    nb_bins = int(np.ceil(nb_points / bin_size))
+    padding = nb_bins * bin_size - nb_points
+
+    def binned(array):
+        # pad with NaN so that the last, incomplete, bin is ignored where needed
+        return np.concatenate((array.astype(np.float64), np.full(padding, np.nan))) \
+            .reshape(nb_bins, bin_size)
+
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        # bins full of NaN (failed sweeps) give NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        freq_bins = binned(frequencies)
+        if mode == "mean":
+            return np.nanmean(freq_bins, axis=1), \
+                [np.nanmean(binned(array), axis=1) for array in data]
+        # min/max: the first and last frequencies of each bin
+        frequencies = np.stack((np.nanmin(freq_bins, axis=1),
+                                np.nanmax(freq_bins, axis=1)), axis=1).ravel()
+        return frequencies, [np.stack((np.nanmin(binned(array), axis=1),
+                                       np.nanmax(binned(array), axis=1)), axis=1).ravel()
+                             for array in data]
+
+
+def running_median(data, window=5):
+    """Median of the window points centered on each point of data, the
+    edges are padded with the first and last values."""
+    padded = np.pad(np.asarray(data, dtype=np.float64), window // 2, mode="edge")
+    return np.median(sliding_window_view(padded, window), axis=1)[:len(data)]
+
+
+def outlier_mask(data_pl, time_per_point, clip_sigma=5., window=5):
+    """Find the spikes (cosmic rays, afterpulses of the APD) of a spectrum
+    by sigma clipping against its running median.
+
+    Only points above the running median are clipped so that narrow
+    ODMR lines are kept, the noise is the shot noise of the median.
+
+    Parameters
+    ----------
+    data_pl: ndarray
+        PL of the N points of the sweep, in kcts/s.
+    time_per_point: float
+        Counting time per frequency point, in s.
+    clip_sigma: float
+        Threshold in number of standard deviations.
+    window: int
+        Number of points of the running median, should be odd.
+
+    Returns
+    -------
+    ndarray of bool: True for the spikes.
+    ndarray: running median of the PL, in kcts/s.
+    """
+    counts = 1e3 * time_per_point * np.asarray(data_pl, dtype=np.float64)
+    median = running_median(counts, window)
+    with np.errstate(invalid="ignore"):
+        mask = counts - median > clip_sigma * np.sqrt(np.maximum(median, 1.))
+    return mask, 1e-3 * median / time_per_point
+
+
+def shot_noise_snr(data_pl, time_per_point, nb_sweeps=1, window=5):
+    """Estimate the contrast of the deepest line of a spectrum and its
+    signal to noise ratio if the noise is the shot noise.
+
+    The depth of the line is taken on the running median of the spectrum
+    so that it is not biased by the noise.
+
+    Parameters
+    ----------
+    data_pl: ndarray
+        PL of the N points, in kcts/s, averaged over nb_sweeps sweeps.
+    time_per_point: float
+        Counting time per frequency point, in s.
+    nb_sweeps: int
+        Number of averaged sweeps.
+    window: int
+        Number of points of the running median.
+
+    Returns
+    -------
+    float: signal to noise ratio
+    float: contrast, relative to the median PL
+    float: baseline, the median PL in kcts/s
+    """
+    baseline = np.median(data_pl)
+    depth = baseline - np.min(running_median(data_pl, window))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # standard deviation of the PL of one point in kcts/s
+        noise = np.sqrt(baseline / (1e3 * time_per_point * nb_sweeps))
+        return depth / noise, depth / baseline, baseline
+
+
+class QualityMonitor:
+    """ Follow the quality of the successive sweeps of an acquisition to
+    reject the bad ones and to know when the average is good enough.
+
+    Parameters
+    ----------
+    clip_sigma: float
+        Threshold of the spikes, in number of standard deviations.
+    max_outliers: int
+        A sweep with more spikes is rejected, negative to accept all.
+    max_drift: float
+        A sweep whose baseline drifted more than this relative value
+        from the previous sweeps is rejected, 0 to accept all.
+    snr_target: float
+        Signal to noise ratio of the average to reach, 0 to never stop.
+    """
+
+    def __init__(self, clip_sigma=5., max_outliers=-1, max_drift=0., snr_target=0.):
+        self.clip_sigma = clip_sigma
+        self.max_outliers = max_outliers
+        self.max_drift = max_drift
+        self.snr_target = snr_target
+        self.reset()
+
+    def reset(self):
+        """Start a new average."""
+        self.sum_pl = None
+        self.nb_sweeps = 0
+        self.rejected = 0
+        self.snr = np.nan
+
+    @property
+    def target_reached(self):
+        """True if the average of the accepted sweeps reached snr_target."""
+        return self.snr_target > 0 and self.snr >= self.snr_target
+
+    def update(self, data_pl, time_per_point):
+        """Compute the quality of a new sweep and add it to the average if
+        it is accepted.
+
+        Parameters
+        ----------
+        data_pl: ndarray
+            PL of the N points of the sweep, in kcts/s.
+        time_per_point: float
+            Counting time per frequency point, in s.
+
+        Returns
+        -------
+        QualityMetrics
+        ndarray: the PL with the spikes replaced by the running median.
+        """
+        if self.sum_pl is not None and len(self.sum_pl) != len(data_pl):
+            # the sweep changed, the average is meaningless
+            self.reset()
+        mask, median = outlier_mask(data_pl, time_per_point, self.clip_sigma)
+        clean_pl = np.where(mask, median, data_pl)
+        _, contrast, baseline = shot_noise_snr(clean_pl, time_per_point)
+        drift = 0.
+        if self.nb_sweeps:
+            drift = baseline / np.median(self.sum_pl / self.nb_sweeps) - 1
+        outliers = int(np.count_nonzero(mask))
+
+        accepted = bool(np.all(np.isfinite(clean_pl))) \
+            and not 0 <= self.max_outliers < outliers \
+            and not 0 < self.max_drift < abs(drift)
+        if accepted:
+            self.sum_pl = clean_pl if self.sum_pl is None else self.sum_pl + clean_pl
+            self.nb_sweeps += 1
+        else:
+            self.rejected += 1
+        self.snr = np.nan
+        if self.nb_sweeps:
+            self.snr = shot_noise_snr(self.sum_pl / self.nb_sweeps, time_per_point,
+                                      self.nb_sweeps)[0]
+        return QualityMetrics(snr=self.snr, contrast=contrast, drift=drift,
+                              outliers=outliers, accepted=accepted), clean_pl
@@ -0,0 +1,43 @@
+""" Saving of the full resolution ODMR spectra, independently of the
+(possibly decimated) data emitted to PyMoDAQ.
+"""
+import re
+from pathlib import Path
+
+import numpy as np
+
+
+class FullResolutionWriter:
+    """ Write each sweep in a numpy file of a folder: sweep_XXXXXX.npz holds
+    the frequency axis of the sweep (frequencies) and its channels (data,
+    an array with one line per channel), so that each file stays consistent
+    whatever the changes of the axis.
+
+    Parameters
+    ----------
+    folder: str or Path
+        Folder where the files are written, created if needed. The
+        numbering continues after the sweeps already in the folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        indexes = [int(match.group(1)) for match in
+                   (re.fullmatch(r"sweep_(\d+)\.np[yz]", path.name)
+                    for path in self.folder.iterdir()) if match]
+        self.index = max(indexes, default=-1) + 1
+
+    def write(self, frequencies, data):
+        """Save a sweep.
+
+        Parameters
+        ----------
+        frequencies: ndarray
+            Frequency axis, in MHz.
+        data: list of ndarray
+            Channels of the sweep.
+        """
+        np.savez(self.folder.joinpath(f"sweep_{self.index:06d}.npz"),
+                 frequencies=frequencies, data=np.stack(data))
+        self.index += 1
@@ -0,0 +1,86 @@
+""" Precomputed plan of an ODMR sweep: frequency axis, MW source payload
+and number of samples of the NI tasks.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# shared UnitRegistry from pint initialized in __init__.py
+from pymodaq_plugins_s2qt_odmr import ureg, Q_
+
+# frequencies: read-only frequency axis (MHz)
+# start, stop, step, power: pint Quantities for the sweep mode
+# mw_frequencies, mw_powers: read-only arrays of the list mode, in MHz and
+#     dBm, empty if the sweep has no reference points
+# odmr_length: number of MW points, including the reference points
+# clock_samples: number of clock pulses, the first one starts the sweep
+# counter_samples: buffer size of the counter tasks (two semi-periods per pulse)
+# read_samples: number of samples read from each counter task
+# ai_samples: number of samples read from the analog input task
+SweepPlan = namedtuple("SweepPlan", ["frequencies", "start", "stop", "step", "power",
+                                     "mw_frequencies", "mw_powers", "interleaved",
+                                     "odmr_length", "clock_samples", "counter_samples",
+                                     "read_samples", "ai_samples"])
+
+
+@lru_cache(maxsize=16)
+def sweep_axis(start_f, stop_f, step_f):
+    """Frequency axis of a sweep, in MHz, the stop frequency is included.
+    The array is read-only and cached, it is shared by the plans of the
+    same range."""
+    frequencies = np.arange(start_f, stop_f + step_f, step_f, dtype=np.float32)
+    frequencies.flags.writeable = False
+    return frequencies
+
+
+@lru_cache(maxsize=16)
+def sweep_plan(start_f, stop_f, step_f, power, interleaved=False, ref_f=2500.,
+               ref_power=-145.):
+    """Compute the plan of a sweep, the result is cached so that going
+    back to previous settings is immediate.
+
+    Parameters
+    ----------
+    start_f, stop_f, step_f: float
+        Frequency range, in MHz, the stop frequency is included.
+    power: float
+        MW power, in dBm.
+    interleaved: bool
+        If True, each frequency is followed by a reference point.
+    ref_f: float
+        Frequency of the reference points, in MHz.
+    ref_power: float
+        Power of the reference points, in dBm.
+
+    Returns
+    -------
+    SweepPlan
+    """
+    frequencies = sweep_axis(start_f, stop_f, step_f)
+
+    mw_frequencies = np.empty(0)
+    mw_powers = np.empty(0)
+    odmr_length = len(frequencies)
+    if interleaved:
+        odmr_length *= 2  # one reference point after each frequency
+        # the source outputs the first point of the list from the reset to
+        # the first clock pulse, which steps it to the second one. Like the
+        # start - step point programmed by MWsource.set_sweep in sweep mode,
+        # this first point is not counted: it is a reference point and the
+        # counted points alternate signal (even) and reference (odd)
+        mw_frequencies = np.full(odmr_length + 1, ref_f)
+        mw_frequencies[1::2] = frequencies
+        mw_powers = np.full(odmr_length + 1, ref_power, dtype=float)
+        mw_powers[1::2] = power
+    mw_frequencies.flags.writeable = False
+    mw_powers.flags.writeable = False
+
+    return SweepPlan(frequencies=frequencies, start=start_f * ureg.MHz,
+                     stop=stop_f * ureg.MHz, step=step_f * ureg.MHz,
+                     power=Q_(power, ureg.dBm), mw_frequencies=mw_frequencies,
+                     mw_powers=mw_powers, interleaved=interleaved,
+                     odmr_length=odmr_length, clock_samples=odmr_length+1,
+                     # count twice for each point +1 for starting the task
+                     counter_samples=2*(odmr_length+1),
+                     read_samples=2*odmr_length+1, ai_samples=odmr_length)
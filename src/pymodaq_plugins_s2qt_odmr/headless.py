@@ -0,0 +1,126 @@
+""" Scripted ODMR acquisition, without the DAQ_Viewer nor the plugin.
+
+Only the hardware and processing modules of this package are imported,
+and they do not depend on PyMoDAQ. The NI and R&S drivers still import
+pymodaq.utils.logger, whose package init loads PyMoDAQ (and Qt in a
+full installation).
+
+It uses the same ODMRController as the DAQ_1DViewer_ODMR plugin, for
+instance::
+
+    from pymodaq_plugins_s2qt_odmr.headless import ODMR
+
+    with ODMR(address="USB::0x0AAD::0x0054::105357::INSTR",
+              counter_channel="Dev1/ctr1", photon_channel="/Dev1/PFI8",
+              clock_channel="Dev1/ctr0", topo_channel="Dev1/ai0",
+              sync_channel="/Dev1/PFI12") as odmr:
+        odmr.configure(start_f=2820, stop_f=2920, step_f=1)
+        result = odmr.sweep()
+"""
+import asyncio
+from collections import namedtuple
+
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_controller import ODMRController
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import sweep_to_pl, \
+    DeadTimeCorrection
+
+# frequencies in MHz, pl in kcts/s (one line per channel), contrast (one
+# line per counter, empty without reference points) and mean topo
+SweepResult = namedtuple("SweepResult", ["frequencies", "pl", "contrast", "topo"])
+
+
+class ODMR:
+    """ Headless ODMR measurement.
+
+    Parameters
+    ----------
+    config: dict
+        Configuration of the acquisition, see default_config in
+        hardware.odmr_controller for the keys and units.
+    """
+
+    def __init__(self, **config):
+        self.controller = ODMRController()
+        self.dead_time_correction = DeadTimeCorrection()
+        self.configure(**config)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Open the communication with the MW source and the NI card.
+
+        Raises
+        ------
+        IOError: if the MW source could not be reached.
+        """
+        if not self.controller.open():
+            raise IOError(f"Cannot open the MW source at {self.controller.config.address}")
+
+    def close(self):
+        self.controller.stop()
+        self.controller.close()
+
+    def configure(self, dead_time_model=None, dead_time=None, **config):
+        """Change the configuration, the hardware is programmed again at
+        the next sweep.
+
+        Parameters
+        ----------
+        dead_time_model: str, optional
+            One of DEAD_TIME_MODELS.
+        dead_time: float, optional
+            Dead time of the detectors, in ns.
+        config: dict
+            Values of the configuration to change.
+
+        Raises
+        ------
+        KeyError: if a key is not a configuration value.
+        """
+        unknown = set(config.keys()) - set(self.controller.config.keys())
+        if unknown:
+            raise KeyError(f"Unknown configuration values: {', '.join(sorted(unknown))}")
+        self.controller.config.update(config)
+        self.controller.mw_ready = False
+        if dead_time_model is not None or dead_time is not None:
+            self.dead_time_correction = DeadTimeCorrection(
+                model=dead_time_model if dead_time_model is not None
+                else self.dead_time_correction.model,
+                dead_time=1e-9*dead_time if dead_time is not None
+                else self.dead_time_correction.dead_time)
+
+    def sweep(self):
+        """Acquire and process one sweep.
+
+        Returns
+        -------
+        SweepResult
+
+        Raises
+        ------
+        SweepFailed: if the hardware still fails after the retries.
+        """
+        sweep = self.controller.grab(update=False)
+        data_pl, data_contrast = sweep_to_pl(sweep, correction=self.dead_time_correction)
+        return SweepResult(frequencies=sweep.x_axis, pl=data_pl, contrast=data_contrast,
+                           topo=float(sweep.topo.mean()))
+
+    async def live(self, nb_sweeps=None):
+        """Asynchronous iterator over successive sweeps, acquired in a
+        thread so that the event loop is not blocked.
+
+        Parameters
+        ----------
+        nb_sweeps: int, optional
+            Number of sweeps to acquire, infinite by default.
+        """
+        loop = asyncio.get_running_loop()
+        ind = 0
+        while nb_sweeps is None or ind < nb_sweeps:
+            yield await loop.run_in_executor(None, self.sweep)
+            ind += 1
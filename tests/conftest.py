@@ -0,0 +1,155 @@
+""" Simulated hardware used to run the ODMR acquisition without the MW
+source nor the NI card.
+"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# stand-ins of PyMoDAQ and of the drivers, after the installed packages so
+# that the real ones are used when available. The path is inherited by the
+# processes spawned by the tests.
+sys.path.append(str(Path(__file__).parent.joinpath("simulated_drivers")))
+
+
+def lorentzian_spectrum(frequencies, rate=1e5, contrast=0.2, center=2870., width=5.):
+    """PL rate (cts/s) of a single ODMR line."""
+    return rate * (1 - contrast / (1 + ((frequencies - center) / (width / 2))**2))
+
+
+class SimulatedMWSource:
+    """Records the frequencies programmed in sweep or list mode."""
+
+    programmed = None  # last programmed source, read by the simulated counters
+
+    def __init__(self):
+        self.model = "Simulated"
+        self.points = None  # programmed points, the first one is not counted
+        self.frequencies = None  # counted points
+        self.nb_programming = 0
+
+    def open_communication(self, address=None):
+        return True
+
+    def close_communication(self):
+        pass
+
+    def program(self, points):
+        # like the R&S sources in external step mode, the source outputs the
+        # first point from the reset to the first clock pulse, and each pulse
+        # steps it to the next one: only the following points are counted
+        self.points = points
+        self.frequencies = points[1:]
+        self.nb_programming += 1
+        SimulatedMWSource.programmed = self
+
+    def set_sweep(self, start=None, stop=None, step=None, power=None):
+        # MWsource.set_sweep programs start - step as the first point
+        step = step.m_as("MHz")
+        self.program(np.arange(start.m_as("MHz") - step, stop.m_as("MHz") + step, step))
+
+    def set_list(self, frequency=None, power=None):
+        self.program(np.asarray(frequency.m_as("MHz")))
+
+    def reset_sweep_position(self):
+        pass
+
+    def reset_list_position(self):
+        pass
+
+    def sweep_on(self):
+        pass
+
+    def list_on(self):
+        pass
+
+    def off(self):
+        pass
+
+
+class SimulatedTask:
+    """Records the timing configuration of a DAQmx task. Like DAQmx, it
+    cannot be configured while it is running."""
+
+    nb_timeouts = 0  # number of WaitUntilTaskDone calls which will time out
+
+    def __init__(self, daq=None):
+        self.daq = daq
+        self.samples = None
+
+    def check_not_running(self):
+        if self.daq is not None and self.daq.running:
+            raise RuntimeError("-200479 task running")
+
+    def CfgImplicitTiming(self, mode, samples):
+        self.check_not_running()
+        self.samples = samples
+
+    def CfgSampClkTiming(self, source, rate, edge, mode, samples):
+        self.check_not_running()
+        self.samples = samples
+
+    def WaitUntilTaskDone(self, timeout):
+        if SimulatedTask.nb_timeouts > 0:
+            SimulatedTask.nb_timeouts -= 1
+            raise RuntimeError("timeout")
+        return 0
+
+    def __getattr__(self, name):
+        # the other DAQmx calls (routing, read position...) do nothing
+        return lambda *args: 0
+
+
+class SimulatedDAQmx:
+    """Counter task returning, for each semi-period of the clock, half of
+    the counts of the current MW point."""
+
+    spectrum = staticmethod(lorentzian_spectrum)
+
+    def __init__(self):
+        self.task = SimulatedTask(self)
+        self.channels = []
+        self.running = False
+
+    def update_task(self, channels=[], clock_settings=None, trigger_settings=None):
+        self.task = SimulatedTask(self)
+        self.channels = channels
+        self.running = False
+
+    def start(self):
+        if self.running:
+            raise RuntimeError("-200479 task running")
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+
+    def readCounter(self, nb_samples, counting_time=10., read_function="Ex"):
+        # the buffer holds two semi-periods per clock pulse, the last
+        # one is not read
+        assert nb_samples == self.task.samples - 1
+        rates = self.spectrum(SimulatedMWSource.programmed.frequencies)
+        time_per_point = counting_time / len(rates)
+        counts = np.repeat(rates * time_per_point / 2, 2)
+        # a last sample which must be dropped
+        return np.append(counts, 1e9)[:nb_samples]
+
+    def readAnalog(self, nb_channels, clock_settings):
+        return np.full(clock_settings.Nsamples, 1.)
+
+
+@pytest.fixture
+def simulated_controller(monkeypatch):
+    """ODMRController driving the simulated hardware."""
+    from pymodaq_plugins_s2qt_odmr.hardware import odmr_controller
+    monkeypatch.setattr(odmr_controller, "DAQmxConnectTerms", lambda *args: 0)
+    controller = odmr_controller.ODMRController(
+        config=dict(clock_channel="Dev1/ctr0", counter_channel="Dev1/ctr1",
+                    topo_channel="Dev1/ai0", counting_time=10., concurrent_setup=False),
+        mw_source=SimulatedMWSource(), daq_factory=SimulatedDAQmx)
+    controller.update_tasks()
+    return controller
@@ -0,0 +1,11 @@
+"""Stand-in of PyDAQmx, see README.rst."""
+DAQmx_Val_DoNotInvertPolarity = 0
+DAQmx_Val_ContSamps = 10123
+DAQmx_Val_FiniteSamps = 10178
+DAQmx_Val_CurrReadPos = 10425
+DAQmx_Val_DoNotOverwriteUnreadSamps = 10159
+DAQmx_Val_Rising = 10280
+
+
+def DAQmxConnectTerms(source, destination, polarity):
+    return 0
@@ -0,0 +1,10 @@
+"""Stand-in of pymodaq.control_modules.viewer_utility_classes, see README.rst."""
+comon_parameters = []
+
+
+class DAQ_Viewer_base:
+    live_mode_available = False
+
+
+def main(plugin_file):
+    pass
@@ -0,0 +1,11 @@
+"""Stand-in of pymodaq.utils.daq_utils, see README.rst."""
+
+
+class ThreadCommand:
+    def __init__(self, command="", attribute=None):
+        self.command = command
+        self.attribute = attribute
+
+
+def getLineInfo():
+    return ""
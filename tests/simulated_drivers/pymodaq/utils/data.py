@@ -0,0 +1,24 @@
+"""Stand-in of pymodaq.utils.data, see README.rst."""
+
+
+class Axis:
+    def __init__(self, label="", units="", data=None, index=0):
+        self.label = label
+        self.units = units
+        self.data = data
+        self.index = index
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get_data(self):
+        return self.data
+
+
+class DataFromPlugins:
+    def __init__(self, name="", data=None, dim="", labels=None, x_axis=None, **kwargs):
+        self.name = name
+        self.data = data
+        self.dim = dim
+        self.labels = labels
+        self.axes = [] if x_axis is None else [x_axis]
@@ -0,0 +1,12 @@
+"""Stand-in of pymodaq.utils.logger, see README.rst."""
+import logging
+from pathlib import Path
+
+
+def set_logger(logger_name, add_handler=False, base_logger=False, add_to_console=False,
+               log_level=None, logger_base_name="pymodaq"):
+    return logging.getLogger(f"{logger_base_name}.{logger_name}")
+
+
+def get_module_name(module__file__path):
+    return Path(module__file__path).stem
@@ -0,0 +1,5 @@
+"""Stand-in of pymodaq.utils.parameter, see README.rst."""
+
+
+class Parameter:
+    pass
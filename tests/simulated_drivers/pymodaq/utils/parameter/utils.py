@@ -0,0 +1 @@
+"""Stand-in of pymodaq.utils.parameter.utils, see README.rst."""
@@ -0,0 +1,60 @@
+"""Stand-in of pymodaq_plugins_daqmx, see README.rst."""
+
+
+class Edge:
+    @staticmethod
+    def names():
+        return ["Rising", "Falling"]
+
+
+class ClockSettings:
+    def __init__(self, source=None, frequency=1000, Nsamples=1000, edge="Rising",
+                 repetition=False):
+        self.source = source
+        self.frequency = frequency
+        self.Nsamples = Nsamples
+        self.edge = edge
+        self.repetition = repetition
+
+
+class TriggerSettings:
+    def __init__(self, trig_source="", enable=False, edge="Rising", level=0.1):
+        self.trig_source = trig_source
+        self.enable = enable
+        self.edge = edge
+        self.level = level
+
+
+class Channel:
+    def __init__(self, name="", source="Analog_Input"):
+        self.name = name
+        self.source = source
+
+
+class AIChannel(Channel):
+    pass
+
+
+class ClockCounter(Channel):
+    def __init__(self, clock_frequency=100, name="", source="Counter"):
+        super().__init__(name=name, source=source)
+        self.clock_frequency = clock_frequency
+
+
+class SemiPeriodCounter(Channel):
+    def __init__(self, value_max, name="", source="Counter"):
+        super().__init__(name=name, source=source)
+        self.value_max = value_max
+
+
+class DAQmx:
+    """Only the class methods used to build the settings, the tasks are
+    simulated by conftest.SimulatedDAQmx."""
+
+    @staticmethod
+    def get_NIDAQ_channels(devices=None, source_type="Analog_Input"):
+        return []
+
+    @staticmethod
+    def getTriggeringSources(devices=None):
+        return []
@@ -0,0 +1,5 @@
+"""Stand-in of pymodaq_plugins_rohdeschwarz, see README.rst."""
+
+
+class MWsource:
+    """The MW source is simulated by conftest.SimulatedMWSource."""
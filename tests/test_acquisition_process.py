@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+import pytest
+import PyDAQmx
+
+from pymodaq_plugins_s2qt_odmr.hardware.acquisition_process import ODMRProcess
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import sweep_to_pl
+from conftest import lorentzian_spectrum, SimulatedMWSource, SimulatedDAQmx
+
+# DAQmxConnectTerms cannot be replaced in the acquisition process
+pytestmark = pytest.mark.skipif("simulated_drivers" not in PyDAQmx.__file__,
+                                reason="the acquisition process needs the simulated PyDAQmx")
+
+
+@pytest.fixture
+def process():
+    process = ODMRProcess(config=dict(clock_channel="Dev1/ctr0", counter_channel="Dev1/ctr1",
+                                      topo_channel="Dev1/ai0", counting_time=10.,
+                                      concurrent_setup=False),
+                          nb_slots=2, mw_source=SimulatedMWSource(),
+                          daq_factory=SimulatedDAQmx)
+    process.update_tasks()
+    yield process
+    process.close()
+
+
+def check_sweep(sweep, frequencies):
+    data_pl, _ = sweep_to_pl(sweep)
+    np.testing.assert_allclose(sweep.x_axis, frequencies)
+    np.testing.assert_allclose(data_pl[0], 1e-3 * lorentzian_spectrum(frequencies), rtol=1e-6)
+
+
+def test_grab(process):
+    for _ in range(3):
+        check_sweep(process.grab(), process.frequencies())
+
+
+def test_live_runs_ahead(process):
+    process.start_live()
+    # the acquisition process does not wait for the sweeps to be read
+    time.sleep(1)
+    frequencies = process.frequencies()
+    process.config.update(stop_f=2870.)
+    # the sweeps acquired before the change keep their frequencies
+    sweep = process.grab(update=False)
+    while len(sweep.x_axis) != len(process.frequencies()):
+        check_sweep(sweep, frequencies)
+        sweep = process.grab(update=False)
+    check_sweep(sweep, process.frequencies())
+    process.stop()
+    # the ring was full during the sleep
+    assert not process.live and process.dropped > 0
+    # back to one sweep per request
+    check_sweep(process.grab(), process.frequencies())
+
+
+def test_live_error_keeps_the_process(process):
+    process.start_live()
+    # the clock frequency cannot be computed
+    process.config.update(counting_time=0.)
+    with pytest.raises(ZeroDivisionError):
+        while True:
+            process.grab(update=False)
+    # the live acquisition ended, but the process still answers
+    assert process.alive and not process.live
+    process.stop()
+    process.config.update(counting_time=10.)
+    check_sweep(process.grab(), process.frequencies())
+
+
+def test_dead_process_does_not_block(process):
+    process.start_live()
+    process._process.terminate()
+    process._process.join(5)
+    with pytest.raises(ConnectionError):
+        process.grab(update=False)
+    # nothing is left to stop
+    process.stop()
+    process.close()
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from pymodaq_plugins_s2qt_odmr.hardware import emission
+
+
+class BlockedConsumer:
+    """process callable which waits until it is released, to fill the queue."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def __call__(self, sweep):
+        self.started.set()
+        assert self.release.wait(5)
+        return sweep
+
+
+def wait_for(condition, timeout=5.):
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_worker_emits_in_order():
+    emitted = []
+    pipeline = emission.EmissionPipeline(lambda sweep: 2 * sweep, emitted.append, maxsize=10)
+    pipeline.start()
+    for sweep in range(10):
+        assert pipeline.put(sweep)
+    assert wait_for(lambda: len(emitted) == 10)
+    pipeline.stop()
+    assert emitted == [2 * sweep for sweep in range(10)]
+    assert (pipeline.pushed, pipeline.emitted, pipeline.dropped) == (10, 10, 0)
+
+
+def test_drop_oldest_when_full():
+    consumer = BlockedConsumer()
+    emitted = []
+    pipeline = emission.EmissionPipeline(consumer, emitted.append, maxsize=2)
+    pipeline.start()
+    pipeline.put(0)
+    assert consumer.started.wait(5)
+    # the worker is busy with 0, the queue holds 2 sweeps
+    assert pipeline.put(1) and pipeline.put(2)
+    assert not pipeline.put(3)
+    assert pipeline.dropped == 1
+    consumer.release.set()
+    assert wait_for(lambda: len(emitted) == 3)
+    pipeline.stop()
+    assert emitted == [0, 2, 3]
+
+
+def test_block_waits_for_a_free_slot():
+    consumer = BlockedConsumer()
+    emitted = []
+    pipeline = emission.EmissionPipeline(consumer, emitted.append, maxsize=1,
+                                         policy="block")
+    pipeline.start()
+    pipeline.put(0)
+    assert consumer.started.wait(5)
+    pipeline.put(1)
+    producer = threading.Thread(target=pipeline.put, args=(2,))
+    producer.start()
+    producer.join(0.1)
+    assert producer.is_alive()
+    consumer.release.set()
+    producer.join(5)
+    assert wait_for(lambda: len(emitted) == 3)
+    pipeline.stop()
+    assert emitted == [0, 1, 2] and pipeline.dropped == 0
+
+
+def test_stop_unblocks_and_discards():
+    consumer = BlockedConsumer()
+    pipeline = emission.EmissionPipeline(consumer, lambda data: None, maxsize=1,
+                                         policy="block")
+    pipeline.start()
+    pipeline.put(0)
+    assert consumer.started.wait(5)
+    pipeline.put(1)
+    producer = threading.Thread(target=pipeline.put, args=(2,))
+    producer.start()
+    consumer.release.set()
+    pipeline.stop()
+    producer.join(5)
+    assert not producer.is_alive()
+    # a stopped pipeline does not take sweeps anymore
+    assert not pipeline.put(3)
+
+
+def test_processing_errors_do_not_stop_the_worker():
+    emitted = []
+
+    def process(sweep):
+        if sweep == 1:
+            raise ValueError("bad sweep")
+        return sweep
+
+    pipeline = emission.EmissionPipeline(process, emitted.append)
+    pipeline.start()
+    for sweep in range(3):
+        pipeline.put(sweep)
+    assert wait_for(lambda: pipeline.emitted + pipeline.failed == 3)
+    pipeline.stop()
+    assert emitted == [0, 2] and pipeline.failed == 1
+
+
+def test_stop_with_flush_processes_the_queue():
+    consumer = BlockedConsumer()
+    emitted = []
+    pipeline = emission.EmissionPipeline(consumer, emitted.append, maxsize=float("inf"))
+    pipeline.start()
+    for sweep in range(5):
+        assert pipeline.put(sweep)
+    assert consumer.started.wait(5)
+    consumer.release.set()
+    pipeline.stop(flush=True)
+    assert emitted == list(range(5)) and pipeline.dropped == 0
+
+
+def test_skipped_sweeps_are_not_emitted():
+    emitted = []
+    pipeline = emission.EmissionPipeline(lambda sweep: sweep if sweep % 2 else None,
+                                         emitted.append)
+    pipeline.start()
+    for sweep in range(4):
+        pipeline.put(sweep)
+    assert wait_for(lambda: pipeline.emitted + pipeline.skipped == 4)
+    pipeline.stop()
+    assert emitted == [1, 3] and pipeline.skipped == 2
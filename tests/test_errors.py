@@ -0,0 +1,31 @@
+import pickle
+
+import pytest
+
+from pymodaq_plugins_s2qt_odmr.hardware import errors
+
+
+def test_errors_are_picklable():
+    # they are sent back by the acquisition process
+    error = errors.SweepFailed([errors.DAQTaskError("counter", "overflow"),
+                                errors.MWSourceError("timeout")])
+    unpickled = pickle.loads(pickle.dumps(error))
+    assert str(unpickled) == str(error)
+    assert unpickled.errors[0].task_name == "counter"
+
+
+def test_retry_recovers_failed_task():
+    calls = []
+    recovered = []
+
+    def sweep():
+        calls.append(None)
+        if len(calls) < 3:
+            raise errors.DAQTaskError("clock", "buffer overflow")
+        return "data"
+
+    assert errors.retry(sweep, attempts=3, backoff=0, recover=recovered.append) == "data"
+    assert [error.task_name for error in recovered] == ["clock", "clock"]
+    with pytest.raises(errors.SweepFailed):
+        calls.clear()
+        errors.retry(sweep, attempts=2, backoff=0)
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# refuse the imports of PyMoDAQ and Qt in the child process
+BLOCK_GUI = """
+import sys
+
+class Blocker:
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in ["pymodaq", "qtpy", "PyQt5", "PyQt6", "PySide2", "PySide6"]:
+            raise ImportError(f"{name} imported")
+
+sys.meta_path.insert(0, Blocker())
+"""
+
+
+def run_python(code):
+    """Run code in a new interpreter with the same path, including the
+    stand-ins of the drivers."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                          timeout=60, env=env)
+
+
+def test_hardware_modules_do_not_import_pymodaq():
+    result = run_python(BLOCK_GUI + """
+from pymodaq_plugins_s2qt_odmr.hardware import errors, emission, odmr_processing, \\
+    sweep_plan, saving
+""")
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.benchmark
+def test_headless_startup_time():
+    # with the stand-ins when the drivers are not installed
+    result = run_python("""
+import time
+start = time.perf_counter()
+import pymodaq_plugins_s2qt_odmr.headless
+print(time.perf_counter() - start)
+""")
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout) < 1.
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pymodaq_plugins_s2qt_odmr.hardware import odmr_controller
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import sweep_to_pl
+from conftest import lorentzian_spectrum, SimulatedTask, SimulatedDAQmx, SimulatedMWSource
+
+
+@pytest.mark.parametrize("interleaved", [False, True])
+@pytest.mark.parametrize("stop_f", [2821., 2870., 2920.])
+def test_grab_simulated_sweep(simulated_controller, stop_f, interleaved):
+    simulated_controller.config.update(stop_f=stop_f, interleaved=interleaved)
+    sweep = simulated_controller.grab()
+    data_pl, data_contrast = sweep_to_pl(sweep)
+    frequencies = simulated_controller.frequencies()
+    np.testing.assert_allclose(data_pl[0], 1e-3 * lorentzian_spectrum(frequencies),
+                               rtol=1e-6)
+    if interleaved:
+        np.testing.assert_allclose(data_contrast[0], lorentzian_spectrum(frequencies)
+                                   / lorentzian_spectrum(np.array([2500.])), rtol=1e-6)
+
+
+def test_mw_programmed_once_per_plan(simulated_controller):
+    mw_source = simulated_controller.mw_source
+    for _ in range(3):
+        simulated_controller.grab(update=False)
+    assert mw_source.nb_programming == 1
+    simulated_controller.config.update(step_f=1.)
+    simulated_controller.grab(update=False)
+    assert mw_source.nb_programming == 2
+
+
+def test_tasks_configured_once_per_settings(simulated_controller, monkeypatch):
+    updates = []
+    update_task = SimulatedDAQmx.update_task
+    monkeypatch.setattr(SimulatedDAQmx, "update_task",
+                        lambda daq, **kwargs: updates.append(daq) or update_task(daq, **kwargs))
+    for _ in range(3):
+        simulated_controller.grab(update=False)
+    # the tasks are only stopped between the sweeps
+    assert not updates
+    simulated_controller.config.update(step_f=1.)
+    simulated_controller.grab(update=False)
+    assert not updates
+    simulated_controller.config.update(counting_time=5.)
+    simulated_controller.grab(update=False)
+    assert len(updates) == len(simulated_controller.daq)
+
+
+def test_retry_after_clock_timeout(simulated_controller, monkeypatch):
+    # the first attempt leaves the counter and ai tasks running
+    monkeypatch.setattr(SimulatedTask, "nb_timeouts", 1)
+    sweep = simulated_controller.grab()
+    data_pl, _ = sweep_to_pl(sweep)
+    np.testing.assert_allclose(data_pl[0], 1e-3 * lorentzian_spectrum(
+        simulated_controller.frequencies()), rtol=1e-6)
+    assert SimulatedTask.nb_timeouts == 0
+    assert not simulated_controller.failed_sweeps
+
+
+def test_concurrent_setup_in_event_loop(simulated_controller, monkeypatch):
+    events = []
+    monkeypatch.setattr(odmr_controller, "DAQmxConnectTerms",
+                        lambda *args: events.append("connect"))
+    monkeypatch.setattr(simulated_controller.mw_source, "sweep_on",
+                        lambda: events.append("sweep_on"))
+    simulated_controller.config.concurrent_setup = True
+    # the tasks are configured again concurrently with the MW programming
+    simulated_controller.config.counting_time = 5.
+
+    async def grab():
+        # e.g. a notebook or a script using the headless API
+        return simulated_controller.grab()
+
+    sweep = asyncio.run(grab())
+    assert np.all(np.isfinite(sweep.counts))
+    # the MW source is armed after the clock is routed to it
+    assert events == ["connect", "sweep_on"]
+
+
+def test_mw_changes_wait_for_the_sweep(simulated_controller, monkeypatch):
+    events = []
+    sweep_started = threading.Event()
+    wait_until_done = SimulatedTask.WaitUntilTaskDone
+
+    def slow_sweep(task, timeout):
+        sweep_started.set()
+        time.sleep(0.2)
+        events.append("sweep done")
+        return wait_until_done(task, timeout)
+
+    monkeypatch.setattr(SimulatedTask, "WaitUntilTaskDone", slow_sweep)
+    grab = threading.Thread(target=simulated_controller.grab)
+    grab.start()
+    assert sweep_started.wait(5)
+    # e.g. commit_settings while the live thread acquires a sweep
+    with simulated_controller.lock:
+        events.append("mw change")
+    grab.join(5)
+    assert events == ["sweep done", "mw change"]
+
+
+@pytest.mark.benchmark
+def test_concurrent_setup_latency(simulated_controller, monkeypatch):
+    # simulated latencies of the VISA programming and of the DAQmx configuration
+    set_sweep = SimulatedMWSource.set_sweep
+    update_task = SimulatedDAQmx.update_task
+    monkeypatch.setattr(SimulatedMWSource, "set_sweep",
+                        lambda source, **kwargs: time.sleep(0.1) or set_sweep(source, **kwargs))
+    monkeypatch.setattr(SimulatedDAQmx, "update_task",
+                        lambda daq, **kwargs: time.sleep(0.03) or update_task(daq, **kwargs))
+
+    def setup_time(concurrent):
+        simulated_controller.config.concurrent_setup = concurrent
+        times = []
+        for _ in range(3):
+            # both the MW source and the tasks are set up again
+            simulated_controller.tasks_ready = False
+            simulated_controller.grab(update=True)
+            times.append(simulated_controller.setup_time)
+        return min(times)
+
+    sequential = setup_time(False)
+    concurrent = setup_time(True)
+    # the setup takes the longest of the two instead of their sum
+    assert sequential > 0.19
+    assert concurrent < 0.75 * sequential
@@ -0,0 +1,155 @@
+import numpy as np
+import pytest
+
+from pymodaq.utils.data import Axis
+from pymodaq_plugins_s2qt_odmr.daq_viewer_plugins.plugins_1D.daq_1Dviewer_ODMR import \
+    DAQ_1DViewer_ODMR, QUALITY_LABELS
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import RawSweep, DeadTimeCorrection, \
+    QualityMonitor
+from test_odmr_processing import raw_counts
+
+
+class StubPlugin:
+    """Attributes of DAQ_1DViewer_ODMR used by process_sweep, without the
+    PyMoDAQ settings."""
+    process_sweep = DAQ_1DViewer_ODMR.process_sweep
+    pl_labels = DAQ_1DViewer_ODMR.pl_labels
+    contrast_labels = DAQ_1DViewer_ODMR.contrast_labels
+
+    def __init__(self, decimation="none", max_points=2000):
+        self.dead_time_correction = DeadTimeCorrection()
+        self.decimation = decimation
+        self.max_points = max_points
+        self.quality = None
+
+
+class Setting:
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def setValue(self, value):
+        self._value = value
+
+
+class Settings:
+    """Settings read by grab_sweep and check_quality."""
+
+    def __init__(self, **values):
+        self.values = dict(remove_spikes=False, max_regrabs=2, async_emission=False,
+                           nb_sweeps=0, rejected=0)
+        self.values.update(values)
+        self.settings = {name: Setting(value) for name, value in self.values.items()}
+
+    def child(self, *names):
+        return self.settings[names[-1]]
+
+
+class QualityStubPlugin(StubPlugin):
+    """Acquire the sweeps of a list, the NaN ones being rejected."""
+    grab_sweep = DAQ_1DViewer_ODMR.grab_sweep
+    check_quality = DAQ_1DViewer_ODMR.check_quality
+
+    def __init__(self, sweeps, live=False):
+        super().__init__()
+        self.settings = Settings()
+        self.quality = QualityMonitor()
+        self.live = live
+        self.sweeps = list(sweeps)
+        self.emitted = []
+        self.data_grabed_signal = self
+        self.emit_status = lambda status: None
+
+    def acquire_sweep(self):
+        return self.sweeps.pop(0)
+
+    def emit(self, data):
+        self.emitted.append(data)
+
+
+def quality_sweep(counts):
+    return RawSweep(counts=raw_counts(counts), topo=np.ones(len(counts)),
+                    time_per_point=1e-3,
+                    x_axis=Axis(data=2860. + np.arange(len(counts)), label="Frequency",
+                                units="MHz"))
+
+
+def pl(data):
+    return [item for item in data if item.name == "ODMR"][0].data[0]
+
+
+def dim(data):
+    return getattr(data.dim, "name", data.dim)
+
+
+def test_process_sweep_golden():
+    # regression of the emitted data for a fixed raw sweep
+    sweep = RawSweep(counts=raw_counts([100, 80, 100, 60]),
+                     topo=np.array([1., 3.]), time_per_point=0.01,
+                     x_axis=Axis(data=np.array([2860., 2870.]), label="Frequency",
+                                 units="MHz"),
+                     extra_counts=[raw_counts([50, 50, 40, 40])],
+                     reference=0, interleaved=True)
+    odmr, contrast, topo = StubPlugin().process_sweep(sweep)
+
+    assert (odmr.name, dim(odmr)) == ("ODMR", "Data1D")
+    assert odmr.labels == ['PL (kcts/s)', 'PL counter 1 (kcts/s)', 'Normalized PL (kcts/s)']
+    np.testing.assert_allclose(odmr.data, [[10., 10.], [5., 4.], [9., 11.25]])
+    np.testing.assert_allclose(odmr.axes[0].get_data(), [2860., 2870.])
+
+    assert (contrast.name, dim(contrast)) == ("Contrast", "Data1D")
+    assert contrast.labels == ['Contrast', 'Contrast counter 1']
+    np.testing.assert_allclose(contrast.data, [[1.25, 1 / 0.6], [1., 1.]])
+
+    assert (topo.name, dim(topo), topo.labels) == ("Topo", "Data0D", ["Topo (nm)"])
+    np.testing.assert_allclose(topo.data, [[2.]])
+
+
+@pytest.mark.parametrize("decimation", ["mean", "min/max"])
+def test_process_sweep_decimated(decimation):
+    nb_points = 1000
+    frequencies = np.linspace(2820., 2920., nb_points)
+    # 1 ms per point, the PL in kcts/s is the number of counts
+    counts = 1 + np.arange(nb_points)
+    sweep = RawSweep(counts=raw_counts(counts), topo=np.ones(nb_points),
+                     time_per_point=1e-3,
+                     x_axis=Axis(data=frequencies, label="Frequency", units="MHz"))
+    odmr, topo = StubPlugin(decimation=decimation, max_points=100).process_sweep(sweep)
+    assert odmr.labels == ['PL (kcts/s)']
+    assert len(odmr.data[0]) == len(odmr.axes[0].get_data()) == 100
+    if decimation == "min/max":
+        # the extrema are kept
+        assert (odmr.data[0].min(), odmr.data[0].max()) == (1., nb_points)
+    else:
+        assert np.mean(odmr.data[0]) == pytest.approx(np.mean(counts))
+
+
+def test_rejected_sweep_grabbed_again_in_scan():
+    plugin = QualityStubPlugin([quality_sweep([np.nan, 100.]), quality_sweep([90., 100.])])
+    plugin.grab_sweep()
+    # only the accepted sweep is emitted
+    assert len(plugin.emitted) == 1 and not plugin.sweeps
+    np.testing.assert_allclose(pl(plugin.emitted[0]), [90., 100.])
+    assert plugin.quality.rejected == 1
+
+
+def test_last_regrab_emitted_in_scan():
+    plugin = QualityStubPlugin([quality_sweep([np.nan, 100.])] * 3)
+    plugin.grab_sweep()
+    # max_regrabs is 2, the scan carries on with the last sweep
+    assert len(plugin.emitted) == 1 and not plugin.sweeps
+    quality = [item for item in plugin.emitted[0] if item.name == "Quality"][0]
+    # same channels as declared by ini_detector
+    assert quality.labels == QUALITY_LABELS
+    assert quality.data[-1][0] == 0.
+
+
+def test_rejected_sweep_skipped_when_live():
+    plugin = QualityStubPlugin([quality_sweep([np.nan, 100.]), quality_sweep([90., 100.])],
+                               live=True)
+    plugin.grab_sweep()
+    plugin.grab_sweep()
+    assert len(plugin.emitted) == 1
+    np.testing.assert_allclose(pl(plugin.emitted[0]), [90., 100.])
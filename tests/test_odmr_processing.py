@@ -0,0 +1,152 @@
+import time
+
+import numpy as np
+import pytest
+from hypothesis import given, strategies as st
+from hypothesis.extra.numpy import arrays
+
+from pymodaq_plugins_s2qt_odmr.hardware.odmr_processing import RawSweep, counts_to_pl, \
+    normalize_pl, interleaved_contrast, sweep_to_pl, decimate, DeadTimeCorrection, \
+    outlier_mask, QualityMonitor
+from conftest import lorentzian_spectrum
+
+
+def raw_counts(counts_per_point):
+    """Semi-period buffer of a sweep: two samples per point and the last,
+    dropped, sample."""
+    half = np.asarray(counts_per_point, dtype=np.float64) / 2
+    return np.append(np.repeat(half, 2), 1e9)
+
+
+@given(arrays(np.uint32, st.integers(1, 500), elements=st.integers(0, 10**6)))
+def test_counts_to_pl_pairing(counts_per_point):
+    data_pl = counts_to_pl(raw_counts(counts_per_point), time_per_point=1e-3)
+    assert len(data_pl) == len(counts_per_point)
+    np.testing.assert_allclose(data_pl, counts_per_point, rtol=1e-12)
+
+
+@given(st.integers(1, 1000))
+def test_counts_to_pl_drops_last_sample(odmr_length):
+    read_data = np.ones(2*odmr_length+1)
+    read_data[-1] = np.nan
+    assert np.all(np.isfinite(counts_to_pl(read_data, time_per_point=1.)))
+
+
+@pytest.mark.parametrize("model", ["non-paralyzable", "paralyzable"])
+def test_dead_time_correction_saturated(model):
+    dead_time = 22e-9
+    true_rates = np.linspace(1e3, 2e7, 1000)
+    if model == "paralyzable":
+        measured = true_rates * np.exp(-true_rates * dead_time)
+    else:
+        measured = true_rates / (1 + true_rates * dead_time)
+    corrected = DeadTimeCorrection(model, dead_time)(measured)
+    np.testing.assert_allclose(corrected, true_rates, rtol=1e-5)
+
+
+@pytest.mark.parametrize("model", ["non-paralyzable", "paralyzable"])
+def test_dead_time_correction_clips_above_saturation(model):
+    correction = DeadTimeCorrection(model, 22e-9)
+    rates = np.array([correction.saturation_rate, 2 * correction.saturation_rate])
+    corrected = correction(rates)
+    assert np.all(np.isfinite(corrected)) and corrected[0] == corrected[1]
+    if model == "paralyzable":
+        assert corrected[0] == pytest.approx(1 / 22e-9)
+    assert DeadTimeCorrection()(rates) is rates
+
+
+def test_normalize_pl_removes_drift():
+    drift = np.linspace(1, 0.5, 50)
+    spectrum = lorentzian_spectrum(np.linspace(2820, 2920, 50))
+    normalized = normalize_pl(spectrum * drift, 1e5 * drift)
+    np.testing.assert_allclose(normalized / normalized.max(), spectrum / spectrum.max())
+
+
+@given(st.integers(1, 500))
+def test_interleaved_contrast(nb_points):
+    signal = np.arange(1, nb_points+1, dtype=np.float64)
+    data_pl = np.stack((signal, 2 * signal), axis=1).ravel()
+    np.testing.assert_allclose(interleaved_contrast(data_pl), 0.5)
+
+
+def test_sweep_to_pl_golden():
+    # regression values of the emitted channels for a fixed raw sweep
+    sweep = RawSweep(counts=raw_counts([100, 80, 100, 60]),
+                     topo=np.ones(8), time_per_point=0.01,
+                     x_axis=np.array([2860., 2870.]),
+                     extra_counts=[raw_counts([50, 50, 40, 40])],
+                     reference=0, interleaved=True)
+    data_pl, data_contrast = sweep_to_pl(sweep)
+    np.testing.assert_allclose(data_pl, [[10., 10.], [5., 4.], [9., 11.25]])
+    np.testing.assert_allclose(data_contrast, [[1.25, 1 / 0.6], [1., 1.]])
+
+
+@given(st.integers(2, 5000), st.integers(2, 500), st.sampled_from(["mean", "min/max"]))
+def test_decimate_bounded(nb_points, max_points, mode):
+    frequencies = np.arange(nb_points, dtype=np.float32)
+    decimated_freqs, (decimated,) = decimate(frequencies, [frequencies.astype(float)],
+                                             max_points, mode)
+    assert len(decimated_freqs) == len(decimated) <= max(max_points, nb_points)
+    if nb_points > max_points:
+        assert len(decimated) <= max_points
+    if mode == "min/max":
+        # the extrema are kept
+        assert decimated.min() == 0 and decimated.max() == nb_points - 1
+
+
+def poisson_spectrum(nb_points=201, time_per_point=1e-3, seed=0):
+    """Shot noise limited ODMR spectrum in kcts/s."""
+    frequencies = np.linspace(2820, 2920, nb_points)
+    counts = np.random.default_rng(seed).poisson(
+        lorentzian_spectrum(frequencies) * time_per_point)
+    return 1e-3 * counts / time_per_point
+
+
+def test_outlier_mask_finds_spikes_only():
+    data_pl = poisson_spectrum()
+    spikes = [10, 50, 180]
+    data_pl[spikes] *= 3
+    mask, median = outlier_mask(data_pl, time_per_point=1e-3)
+    # the ODMR line at the center is not a spike
+    np.testing.assert_array_equal(np.flatnonzero(mask), spikes)
+    assert np.all(np.abs(median[spikes] / 100 - 1) < 0.1)
+
+
+def test_quality_monitor_snr_grows_with_average():
+    quality = QualityMonitor()
+    metrics = [quality.update(poisson_spectrum(seed=seed), 1e-3)[0] for seed in range(16)]
+    assert all(metric.accepted for metric in metrics)
+    assert metrics[0].contrast == pytest.approx(0.2, abs=0.05)
+    # shot noise of 100 cts per point: 20 cts deep line, averaged 16 times
+    assert metrics[-1].snr == pytest.approx(20 / np.sqrt(100 / 16), rel=0.15)
+    assert abs(metrics[-1].drift) < 0.01
+
+
+def test_quality_monitor_rejects_and_stops():
+    quality = QualityMonitor(max_outliers=0, max_drift=0.1, snr_target=1e9)
+    quality.update(poisson_spectrum(), 1e-3)
+    data_pl = poisson_spectrum(seed=1)
+    data_pl[20] *= 3
+    assert not quality.update(data_pl, 1e-3)[0].accepted
+    assert not quality.update(1.5 * poisson_spectrum(seed=2), 1e-3)[0].accepted
+    assert not quality.update(np.full(201, np.nan), 1e-3)[0].accepted
+    assert (quality.nb_sweeps, quality.rejected) == (1, 3)
+    assert not quality.target_reached
+    quality.snr_target = 1
+    assert quality.target_reached
+
+
+@pytest.mark.benchmark
+def test_processing_time_per_point():
+    # wall clock limit, only run on demand with -m benchmark
+    odmr_length = 100000
+    sweep = RawSweep(counts=np.random.poisson(100, 2*odmr_length+1).astype(np.uint32),
+                     topo=np.ones(odmr_length), time_per_point=1e-3,
+                     x_axis=np.arange(odmr_length, dtype=np.float32))
+    correction = DeadTimeCorrection("paralyzable", 22e-9)
+    sweep_to_pl(sweep, correction)  # fill the cache of the inversion table
+    start = time.perf_counter()
+    for _ in range(10):
+        sweep_to_pl(sweep, correction)
+    time_per_point = (time.perf_counter() - start) / 10 / odmr_length
+    assert time_per_point < 1e-6
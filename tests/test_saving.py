@@ -0,0 +1,27 @@
+import numpy as np
+
+from pymodaq_plugins_s2qt_odmr.hardware.saving import FullResolutionWriter
+
+
+def test_each_sweep_keeps_its_axis(tmp_path):
+    writer = FullResolutionWriter(tmp_path)
+    writer.write(np.array([1., 2.]), [np.array([10., 20.])])
+    writer.write(np.array([1., 2., 3.]), [np.array([10., 20., 30.]), np.ones(3)])
+    first = np.load(tmp_path / "sweep_000000.npz")
+    np.testing.assert_array_equal(first["frequencies"], [1., 2.])
+    np.testing.assert_array_equal(first["data"], [[10., 20.]])
+    second = np.load(tmp_path / "sweep_000001.npz")
+    np.testing.assert_array_equal(second["frequencies"], [1., 2., 3.])
+    assert second["data"].shape == (2, 3)
+
+
+def test_numbering_continues_after_the_last_sweep(tmp_path):
+    writer = FullResolutionWriter(tmp_path)
+    for _ in range(3):
+        writer.write(np.array([1.]), [np.array([1.])])
+    (tmp_path / "sweep_000001.npz").unlink()
+    writer = FullResolutionWriter(tmp_path)
+    writer.write(np.array([1.]), [np.array([2.])])
+    # the last sweep is not overwritten
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        ["sweep_000000.npz", "sweep_000002.npz", "sweep_000003.npz"]
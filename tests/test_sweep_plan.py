@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+import pytest
+from hypothesis import given, strategies as st
+
+from pymodaq_plugins_s2qt_odmr.hardware.sweep_plan import sweep_plan, sweep_axis
+
+
+@given(st.integers(2000, 3000), st.integers(1, 400), st.integers(1, 20), st.booleans())
+def test_sample_counts(start_f, nb_steps, step_f, interleaved):
+    plan = sweep_plan(start_f, start_f + nb_steps*step_f, step_f, 0., interleaved=interleaved)
+    nb_points = nb_steps + 1  # the stop frequency is included
+    assert len(plan.frequencies) == nb_points
+    assert plan.odmr_length == (2 if interleaved else 1) * nb_points
+    # one more clock pulse to start the counting
+    assert plan.clock_samples == plan.odmr_length + 1
+    # two semi-periods per pulse, the last one is not read
+    assert plan.counter_samples == 2 * plan.clock_samples
+    assert plan.read_samples == plan.counter_samples - 1
+    assert plan.ai_samples == plan.odmr_length
+
+
+def test_interleaved_list():
+    plan = sweep_plan(2860., 2880., 10., -10., interleaved=True, ref_f=2500., ref_power=-145.)
+    np.testing.assert_array_equal(plan.mw_frequencies,
+                                  [2500., 2860., 2500., 2870., 2500., 2880., 2500.])
+    np.testing.assert_array_equal(plan.mw_powers[:3], [-145., -10., -145.])
+    # the counted points, after the first one, alternate signal and reference
+    np.testing.assert_array_equal(plan.mw_frequencies[1::2], plan.frequencies)
+    assert not plan.mw_frequencies.flags.writeable and not plan.mw_powers.flags.writeable
+
+
+def test_plan_is_cached_and_read_only():
+    plan = sweep_plan(2820., 2920., 2., 0.)
+    assert sweep_plan(2820., 2920., 2., 0.) is plan
+    assert not plan.frequencies.flags.writeable
+    assert len(plan.mw_frequencies) == 0
+    # the axis is shared with the plans of the same range
+    assert sweep_axis(2820., 2920., 2.) is plan.frequencies
+    assert sweep_plan(2820., 2920., 2., 0., interleaved=True).frequencies is plan.frequencies
+
+
+@pytest.mark.benchmark
+def test_long_interleaved_plan_time():
+    start = time.perf_counter()
+    plan = sweep_plan(2000., 3000., 0.01, 0., interleaved=True)
+    assert len(plan.mw_frequencies) == 2 * len(plan.frequencies) + 1 > 200000
+    assert time.perf_counter() - start < 0.1